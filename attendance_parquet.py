@@ -0,0 +1,209 @@
+"""Columnar Parquet snapshot of the attendance table.
+
+Rows are stored typed: Clock In Date as date32, Time / Clock Out Time as
+time32[s] (null while a shift is open), and Org / Name dictionary-encoded.
+The snapshot is partitioned by the month of Clock In Date:
+
+    attendance_parquet/
+        _manifest.csv                      # month -> file, replaced atomically
+        month=2024-01/part-<token>.parquet
+
+Readers only trust files listed in the manifest, so a crashed write never
+exposes a half-written partition. A save only rewrites the months whose rows
+changed.
+
+Rows come back month by month, in their original order within each month.
+Punches arrive in time order, so this is nearly always the order they were
+saved in. Nothing depends on row order: the repository rebuilds its indexes
+from the rows it reads, and views sort explicitly.
+
+pyarrow is optional; install it to use ATTENDANCE_SNAPSHOT=parquet.
+Run ``python attendance_parquet.py attendance.csv attendance_parquet`` to
+migrate an existing CSV once.
+"""
+import argparse
+import csv
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pq = None
+
+ATTENDANCE_COLUMNS = ["Email", "Phone", "Name", "Org", "Clock In Date", "Time", "Clock Out Time", "User ID"]
+MANIFEST_FILE = "_manifest.csv"
+MANIFEST_COLUMNS = ["Month", "File", "Rows", "Hash"]
+NO_MONTH = "none"  # partition for rows without a parseable Clock In Date
+
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError("The Parquet attendance snapshot needs pyarrow (pip install pyarrow)")
+
+
+def arrow_schema():
+    require_pyarrow()
+    return pa.schema([
+        ("Email", pa.string()),
+        ("Phone", pa.string()),
+        ("Name", pa.dictionary(pa.int32(), pa.string())),
+        ("Org", pa.dictionary(pa.int32(), pa.string())),
+        ("Clock In Date", pa.date32()),
+        ("Time", pa.time32("s")),
+        ("Clock Out Time", pa.time32("s")),
+        ("User ID", pa.string()),
+    ])
+
+
+def manifest_path(directory):
+    return os.path.join(directory, MANIFEST_FILE)
+
+
+def _parse_column(values, parse, column):
+    # Empty strings become nulls; anything else that does not parse is an error,
+    # never a silently dropped value
+    present = values != ""
+    parsed = parse(values.where(present))
+    bad = present & parsed.isna()
+    if bad.any():
+        raise ValueError(f"Unparseable {column} value(s): {values[bad].unique()[:5].tolist()}")
+    return parsed
+
+
+def _seconds(values):
+    return pd.to_timedelta(values, errors="coerce").dt.total_seconds()
+
+
+def to_arrow(frame):
+    frame = frame.reindex(columns=ATTENDANCE_COLUMNS).fillna("").astype(str)
+    dates = _parse_column(frame["Clock In Date"], lambda v: pd.to_datetime(v, format="%Y-%m-%d", errors="coerce"), "Clock In Date")
+    arrays = [
+        pa.array(frame["Email"], pa.string()),
+        pa.array(frame["Phone"], pa.string()),
+        pa.array(frame["Name"], pa.string()).dictionary_encode(),
+        pa.array(frame["Org"], pa.string()).dictionary_encode(),
+        pa.array(dates).cast(pa.date32()),
+    ]
+    for column in ("Time", "Clock Out Time"):
+        seconds = _parse_column(frame[column], _seconds, column)
+        arrays.append(pa.array(seconds.astype("Int64"), pa.int32()).cast(pa.time32("s")))
+    arrays.append(pa.array(frame["User ID"], pa.string()))
+    return pa.Table.from_arrays(arrays, schema=arrow_schema())
+
+
+def _format_unique(column, format_values):
+    # Format each distinct value once (a history has few distinct dates and
+    # clock times), then gather; nulls become ""
+    valid = column.is_valid().to_numpy(zero_copy_only=False)
+    values = pc.fill_null(column.cast(pa.int32()), 0).to_numpy()
+    distinct, inverse = np.unique(values, return_inverse=True)
+    text = np.append(format_values(distinct), "")
+    return text[np.where(valid, inverse, len(distinct))]
+
+
+def _date_strings(days):
+    return np.datetime_as_string(days.astype("datetime64[D]"), unit="D")
+
+
+def _time_strings(seconds):
+    return np.array([f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in seconds.tolist()], dtype=str)
+
+
+def from_arrow(table):
+    # Back to the all-string frame the app works with, column by column in
+    # Arrow / numpy rather than per row
+    out = pd.DataFrame(index=pd.RangeIndex(table.num_rows))
+    for column in ("Email", "Phone", "Name", "Org", "User ID"):
+        values = table[column]
+        if pa.types.is_dictionary(values.type):
+            values = values.cast(pa.string())
+        out[column] = pc.fill_null(values, "").to_pandas()
+    out["Clock In Date"] = _format_unique(table["Clock In Date"], _date_strings)
+    for column in ("Time", "Clock Out Time"):
+        out[column] = _format_unique(table[column], _time_strings)
+    return out[ATTENDANCE_COLUMNS]
+
+
+def _months(frame):
+    month = frame["Clock In Date"].astype(str).str.slice(0, 7)
+    return month.where(month.str.fullmatch(r"\d{4}-\d{2}"), NO_MONTH)
+
+
+def _frame_hash(frame):
+    return str(int(pd.util.hash_pandas_object(frame, index=False).sum()) & 0xFFFFFFFFFFFFFFFF)
+
+
+def read_manifest(directory):
+    path = manifest_path(directory)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        return {row["Month"]: row for row in csv.DictReader(f)}
+
+
+def read_snapshot(directory):
+    """All attendance rows as strings, grouped by month (see above)."""
+    require_pyarrow()
+    manifest = read_manifest(directory)
+    entries = [e for _, e in sorted(manifest.items())]
+    if not entries:
+        return pd.DataFrame(columns=ATTENDANCE_COLUMNS)
+    tables = [pq.read_table(os.path.join(directory, e["File"]), schema=arrow_schema()) for e in entries]
+    return from_arrow(pa.concat_tables(tables))
+
+
+def write_snapshot(frame, directory, write_manifest):
+    # write_manifest(path, write) must replace the manifest atomically, e.g. storage.atomic_write
+    require_pyarrow()
+    os.makedirs(directory, exist_ok=True)
+    frame = frame.reindex(columns=ATTENDANCE_COLUMNS).fillna("").astype(str)
+    old = read_manifest(directory)
+    new = {}
+    for month, part in frame.groupby(_months(frame), sort=True):
+        part_hash = _frame_hash(part)
+        entry = old.get(month)
+        if entry is not None and entry["Hash"] == part_hash and int(entry["Rows"]) == len(part):
+            new[month] = entry
+            continue
+        relative = os.path.join(f"month={month}", f"part-{uuid.uuid4().hex}.parquet")
+        os.makedirs(os.path.join(directory, f"month={month}"), exist_ok=True)
+        pq.write_table(to_arrow(part), os.path.join(directory, relative))
+        new[month] = {"Month": month, "File": relative, "Rows": str(len(part)), "Hash": part_hash}
+
+    def write(f):
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_COLUMNS)
+        writer.writeheader()
+        writer.writerows(new[m] for m in sorted(new))
+
+    write_manifest(manifest_path(directory), write)
+    # Old partition files are only removed once the new manifest no longer lists them
+    live = {e["File"] for e in new.values()}
+    for entry in old.values():
+        if entry["File"] not in live:
+            try:
+                os.remove(os.path.join(directory, entry["File"]))
+            except OSError:
+                pass
+
+
+def main():
+    from storage import atomic_write, parse_attendance_file
+
+    parser = argparse.ArgumentParser(description="Migrate attendance.csv to the Parquet snapshot format.")
+    parser.add_argument("csv_file", nargs="?", default="attendance.csv")
+    parser.add_argument("directory", nargs="?", default="attendance_parquet")
+    args = parser.parse_args()
+
+    frame = parse_attendance_file(args.csv_file)
+    write_snapshot(frame, args.directory, atomic_write)
+    print(f"Wrote {len(frame)} rows in {len(read_manifest(args.directory))} monthly partitions to {args.directory}")
+
+
+if __name__ == "__main__":
+    main()
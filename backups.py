@@ -0,0 +1,294 @@
+"""Deduplicated, compressed backups of the data tables.
+
+A snapshot of a table is cut into chunks of rows at content-defined
+boundaries (a row whose hash is a multiple of CHUNK_DIVISOR ends a chunk), so
+an edit, insert or delete only changes the chunk it falls in and every other
+chunk is shared with the previous snapshot. Chunks are gzip-compressed CSV
+stored once, named by the SHA-256 of their CSV bytes, so an unchanged chunk
+of a large attendance table is never written or compressed again:
+
+    backups/
+        _manifest.csv                   # one row per snapshot, replaced atomically
+        snapshots/<snapshot id>.json    # table, columns, ordered chunk list
+        chunks/<ab>/<sha256>.csv.gz
+
+snapshot_set() takes snapshots of several tables as one set (one manifest
+update), which is what the app backs up and restores together. Restoring a
+snapshot concatenates its chunks, so any point in time that still has a
+snapshot is reconstructed exactly. prune() applies the retention policy to
+whole sets and deletes chunks no kept snapshot refers to.
+
+Run ``python backups.py`` to list snapshot sets, or ``python backups.py --prune``.
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import uuid
+import zipfile
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from storage import atomic_write, file_signature
+
+MANIFEST_FILE = "_manifest.csv"
+MANIFEST_COLUMNS = ["Id", "Set", "Table", "Created", "Rows", "Chunks", "Note"]
+CREATED_FORMAT = "%Y-%m-%dT%H:%M:%S"
+CHUNK_DIVISOR = 64       # average chunk size, in rows
+MAX_CHUNK_ROWS = 1024    # hard cap, for tables with long runs of boundary-free rows
+
+# Default retention: the last KEEP_LAST snapshot sets, plus the newest of
+# each of the last KEEP_DAILY days and KEEP_WEEKLY ISO weeks
+KEEP_LAST = 10
+KEEP_DAILY = 7
+KEEP_WEEKLY = 4
+
+LEGACY_PATTERN = re.compile(r"^(?P<table>[a-z_]+)_backup_(?P<stamp>\d{8}_\d{6})\.csv$")
+
+
+def _write_bytes(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    atomic_write(path, lambda f: f.write(data), binary=True)
+
+
+def row_hashes(frame):
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+
+
+def chunk_bounds(hashes):
+    """(start, stop) row ranges of the content-defined chunks, from row_hashes()."""
+    if len(hashes) == 0:
+        return []
+    ends = set((hashes % CHUNK_DIVISOR == 0).nonzero()[0] + 1)
+    ends.add(len(hashes))
+    bounds = []
+    start = 0
+    for end in sorted(ends):
+        while end - start > MAX_CHUNK_ROWS:
+            bounds.append((start, start + MAX_CHUNK_ROWS))
+            start += MAX_CHUNK_ROWS
+        if end > start:
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+
+def chunk_payloads(frame, bounds):
+    """Headerless CSV bytes of each (start, stop) row range of frame (all strings)."""
+    if frame.apply(lambda column: column.str.contains("\n", regex=False).any()).any():
+        # A quoted multi-line value: lines are not rows, so serialize chunk by chunk
+        return [frame.iloc[start:stop].to_csv(index=False, header=False, lineterminator="\n").encode("utf-8")
+                for start, stop in bounds]
+    # Otherwise serialize the table once and cut it at row boundaries
+    lines = frame.to_csv(index=False, header=False, lineterminator="\n").split("\n")
+    return [("\n".join(lines[start:stop]) + "\n").encode("utf-8") for start, stop in bounds]
+
+
+class BackupStore:
+    def __init__(self, directory, keep_last=KEEP_LAST, keep_daily=KEEP_DAILY, keep_weekly=KEEP_WEEKLY):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+        self._lock = threading.RLock()
+        self._manifest = None
+        self._manifest_signature = None
+
+    # --- Paths ---
+    @property
+    def manifest_file(self):
+        return os.path.join(self.directory, MANIFEST_FILE)
+
+    def _snapshot_file(self, snapshot_id):
+        return os.path.join(self.directory, "snapshots", f"{snapshot_id}.json")
+
+    def _chunk_file(self, digest):
+        return os.path.join(self.directory, "chunks", digest[:2], f"{digest}.csv.gz")
+
+    # --- Manifest ---
+    def manifest(self):
+        """All snapshots, oldest first; re-read only when the manifest file changes."""
+        with self._lock:
+            signature = file_signature(self.manifest_file)
+            if self._manifest is None or signature != self._manifest_signature:
+                if signature is None:
+                    manifest = pd.DataFrame(columns=MANIFEST_COLUMNS)
+                else:
+                    manifest = pd.read_csv(self.manifest_file, dtype=str).reindex(columns=MANIFEST_COLUMNS).fillna("")
+                    # Snapshots taken on their own form a set of one
+                    manifest["Set"] = manifest["Set"].where(manifest["Set"] != "", manifest["Id"])
+                self._manifest = manifest.sort_values(["Created", "Id"], kind="stable").reset_index(drop=True)
+                self._manifest_signature = signature
+            return self._manifest
+
+    def _write_manifest(self, manifest):
+        buffer = io.StringIO()
+        manifest[MANIFEST_COLUMNS].to_csv(buffer, index=False)
+        _write_bytes(self.manifest_file, buffer.getvalue().encode("utf-8"))
+        self._manifest = None
+
+    def sets(self):
+        """One row per snapshot set, newest first: Set, Created, Note, Tables, Rows."""
+        manifest = self.manifest()
+        if manifest.empty:
+            return pd.DataFrame(columns=["Set", "Created", "Note", "Tables", "Rows"])
+        grouped = manifest.assign(Rows=manifest["Table"] + ": " + manifest["Rows"]).groupby("Set", sort=False)
+        sets = grouped[["Created", "Note"]].first()
+        sets["Tables"] = grouped["Table"].agg(", ".join)
+        sets["Rows"] = grouped["Rows"].agg(", ".join)
+        return sets.reset_index().sort_values(["Created", "Set"], ascending=False, kind="stable").reset_index(drop=True)
+
+    # --- Write ---
+    def _store_chunk(self, data):
+        # Named by the hash of the chunk's own bytes, so equal names mean equal rows
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._chunk_file(digest)
+        if not os.path.exists(path):
+            # mtime=0 keeps the compressed bytes a function of the content only
+            _write_bytes(path, gzip.compress(data, mtime=0))
+        return digest
+
+    def _write_snapshot(self, snapshot_id, table, frame):
+        bounds = chunk_bounds(row_hashes(frame))
+        chunks = [self._store_chunk(data) for data in chunk_payloads(frame, bounds)]
+        record = {"table": table, "columns": list(frame.columns), "rows": len(frame), "chunks": chunks}
+        _write_bytes(self._snapshot_file(snapshot_id), json.dumps(record).encode("utf-8"))
+        return len(chunks)
+
+    def snapshot_set(self, tables, note="", created=None):
+        """Store {table: frame (all strings)} as one snapshot set; returns the set id."""
+        created = created or datetime.now()
+        stamp = f"{created.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        set_id = f"set_{stamp}" if len(tables) > 1 else f"{next(iter(tables))}_{stamp}"
+        entries = []
+        with self._lock:
+            for table, frame in tables.items():
+                frame = frame.fillna("").astype(str)
+                snapshot_id = set_id if len(tables) == 1 else f"{table}_{stamp}"
+                chunks = self._write_snapshot(snapshot_id, table, frame)
+                entries.append({"Id": snapshot_id, "Set": set_id, "Table": table,
+                                "Created": created.strftime(CREATED_FORMAT), "Rows": str(len(frame)),
+                                "Chunks": str(chunks), "Note": note})
+            # The set only becomes visible once all of its snapshots are on disk
+            self._write_manifest(pd.concat([self.manifest(), pd.DataFrame(entries)], ignore_index=True))
+        return set_id
+
+    def snapshot(self, table, frame, note="", created=None):
+        """Store frame (all strings) as a new snapshot of table; returns its id."""
+        return self.snapshot_set({table: frame}, note=note, created=created)
+
+    # --- Read ---
+    def restore(self, snapshot_id):
+        """The table exactly as it was when snapshot_id was taken (all strings)."""
+        with open(self._snapshot_file(snapshot_id), "r", encoding="utf-8") as f:
+            record = json.load(f)
+        data = b"".join(self._read_chunk(digest) for digest in record["chunks"])
+        if not data:
+            return pd.DataFrame(columns=record["columns"])
+        return pd.read_csv(io.BytesIO(data), header=None, names=record["columns"], dtype=str,
+                           keep_default_na=False)
+
+    def _read_chunk(self, digest):
+        with gzip.open(self._chunk_file(digest), "rb") as f:
+            return f.read()
+
+    def restore_set(self, set_id):
+        """{table: frame} for every table in the set."""
+        manifest = self.manifest()
+        members = manifest[manifest["Set"] == set_id]
+        return {table: self.restore(snapshot_id) for table, snapshot_id in zip(members["Table"], members["Id"])}
+
+    def zip_bytes(self, set_id):
+        # <table>.csv for every table of the set
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            for table, frame in self.restore_set(set_id).items():
+                archive.writestr(f"{table}.csv", frame.to_csv(index=False))
+        return buffer.getvalue()
+
+    # --- Retention ---
+    def _kept_sets(self, sets, now):
+        # sets: newest first, as from sets()
+        created = pd.to_datetime(sets["Created"], format=CREATED_FORMAT)
+        kept = set(sets["Set"].iloc[:self.keep_last])
+        recent_days = created >= (now - timedelta(days=self.keep_daily)).replace(hour=0, minute=0, second=0)
+        kept.update(sets[recent_days].groupby(created[recent_days].dt.date, sort=False)["Set"].first())
+        recent_weeks = created >= now - timedelta(weeks=self.keep_weekly)
+        weeks = created[recent_weeks].dt.strftime("%G-%V")
+        kept.update(sets[recent_weeks].groupby(weeks, sort=False)["Set"].first())
+        return kept
+
+    def prune(self, now=None):
+        """Apply the retention policy; returns the number of snapshot sets removed."""
+        now = now or datetime.now()
+        with self._lock:
+            manifest = self.manifest()
+            kept = manifest["Set"].isin(self._kept_sets(self.sets(), now))
+            removed = manifest[~kept]
+            if removed.empty:
+                return 0
+            self._write_manifest(manifest[kept])
+            for snapshot_id in removed["Id"]:
+                try:
+                    os.remove(self._snapshot_file(snapshot_id))
+                except OSError:
+                    pass
+            self._collect_chunks(manifest.loc[kept, "Id"])
+            return removed["Set"].nunique()
+
+    def _collect_chunks(self, kept_ids):
+        live = set()
+        for snapshot_id in kept_ids:
+            with open(self._snapshot_file(snapshot_id), "r", encoding="utf-8") as f:
+                live.update(json.load(f)["chunks"])
+        chunk_root = os.path.join(self.directory, "chunks")
+        if not os.path.isdir(chunk_root):
+            return
+        for prefix in os.listdir(chunk_root):
+            for name in os.listdir(os.path.join(chunk_root, prefix)):
+                if name.endswith(".csv.gz") and name[:-len(".csv.gz")] not in live:
+                    os.remove(os.path.join(chunk_root, prefix, name))
+
+    # --- Migration ---
+    def import_legacy(self):
+        """Turn old full-copy backups (users_backup_YYYYmmdd_HHMMSS.csv) into snapshots."""
+        if not os.path.isdir(self.directory):
+            return 0
+        imported = 0
+        for name in sorted(os.listdir(self.directory)):
+            match = LEGACY_PATTERN.match(name)
+            if not match:
+                continue
+            path = os.path.join(self.directory, name)
+            frame = pd.read_csv(path, dtype=str, keep_default_na=False)
+            created = datetime.strptime(match.group("stamp"), "%Y%m%d_%H%M%S")
+            snapshot_id = self.snapshot(match.group("table"), frame, note=f"imported from {name}", created=created)
+            # Only drop the old copy once its snapshot reads back identical
+            if self.restore(snapshot_id).equals(frame.astype(str)):
+                os.remove(path)
+            imported += 1
+        return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List or prune the deduplicated table backups.")
+    parser.add_argument("directory", nargs="?", default="backups")
+    parser.add_argument("--prune", action="store_true", help="apply the retention policy")
+    args = parser.parse_args()
+
+    store = BackupStore(args.directory)
+    imported = store.import_legacy()
+    if imported:
+        print(f"Imported {imported} legacy backup file(s)")
+    if args.prune:
+        print(f"Removed {store.prune()} snapshot(s)")
+    print(store.sets().to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
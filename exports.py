@@ -0,0 +1,50 @@
+"""Download formats for attendance exports.
+
+export_bytes() turns an attendance frame into (bytes, file name, mime type)
+for st.download_button. Parquet uses the typed layout of
+attendance_parquet.py and needs pyarrow; available_formats() leaves it out
+when pyarrow is missing.
+"""
+import gzip
+import io
+import zipfile
+
+import attendance_parquet
+
+CSV = "csv"
+CSV_GZIP = "csv.gz"
+ZIP = "zip"
+PARQUET = "parquet"
+FORMATS = [CSV, CSV_GZIP, ZIP, PARQUET]
+FORMAT_LABELS = {CSV: "CSV", CSV_GZIP: "CSV (gzip)", ZIP: "CSV (zip)", PARQUET: "Parquet"}
+
+
+def available_formats():
+    return [f for f in FORMATS if f != PARQUET or attendance_parquet.pa is not None]
+
+
+def in_date_range(att, start_date=None, end_date=None):
+    # Clock In Date is YYYY-MM-DD, so string comparison is date order
+    if start_date:
+        att = att[att["Clock In Date"] >= start_date]
+    if end_date:
+        att = att[att["Clock In Date"] <= end_date]
+    return att
+
+
+def export_bytes(att, fmt, name):
+    """(data, file_name, mime) for att in format fmt; name is the file name without extension."""
+    if fmt == PARQUET:
+        attendance_parquet.require_pyarrow()
+        buffer = io.BytesIO()
+        attendance_parquet.pq.write_table(attendance_parquet.to_arrow(att), buffer, compression="zstd")
+        return buffer.getvalue(), f"{name}.parquet", "application/vnd.apache.parquet"
+    data = att.to_csv(index=False).encode("utf-8")
+    if fmt == CSV_GZIP:
+        return gzip.compress(data, mtime=0), f"{name}.csv.gz", "application/gzip"
+    if fmt == ZIP:
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(f"{name}.csv", data)
+        return buffer.getvalue(), f"{name}.zip", "application/zip"
+    return data, f"{name}.csv", "text/csv"
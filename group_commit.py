@@ -0,0 +1,107 @@
+"""Write-behind group commit for registrations and clock-in/out punches.
+
+Sessions submit() single-row writes (storage.ADD_USER, CLOCK_IN, CLOCK_OUT)
+to one writer thread per process instead of each taking the data lock and
+syncing the disk on its own. The writer waits up to GROUP_COMMIT_WINDOW for
+more writes to arrive and applies the whole burst with
+repository.apply_writes(): one lock, one append (or transaction) and one
+fsync for all of them.
+
+submit() returns a Ticket at once. Ticket.wait() returns the write's result
+once it is durable on disk, or raises its error, so anything the UI
+acknowledges survives a crash. repository.apply_writes() is all or nothing,
+so a batch that fails is retried one write at a time and one bad write does
+not fail the others.
+
+close() commits whatever is still queued and stops the thread; it is
+registered with atexit so a shutdown never drops queued writes.
+"""
+import atexit
+import queue
+import threading
+import time
+
+GROUP_COMMIT_WINDOW = 0.2  # seconds a write may wait for others to share its commit
+MAX_BATCH = 500
+
+
+class Ticket:
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def _resolve(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """The write's result once committed; raises its error, or TimeoutError if not committed in time."""
+        if not self._done.wait(timeout):
+            raise TimeoutError("The write is not committed yet")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class GroupCommitQueue:
+    def __init__(self, repository, window=GROUP_COMMIT_WINDOW, max_batch=MAX_BATCH):
+        self.repository = repository
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._closing = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, op, *args):
+        with self._closing:
+            if self._closed:
+                raise RuntimeError("The write queue is closed")
+            ticket = Ticket()
+            self._queue.put((op, args, ticket))
+        return ticket
+
+    def close(self, timeout=None):
+        with self._closing:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            results = self.repository.apply_writes([(op, args) for op, args, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                for item in batch:
+                    self._commit([item])
+                return
+            batch[0][2]._resolve(error=e)
+            return
+        for (_, _, ticket), result in zip(batch, results):
+            ticket._resolve(result)
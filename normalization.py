@@ -0,0 +1,154 @@
+"""Phone / email normalization shared by the app and the storage backends.
+
+The scalar functions handle single values (form input, lookups). The
+*_series functions are vectorized versions for whole columns (file loads,
+saves, bulk imports) and give the same result on string input.
+
+Run ``python normalization.py users.csv attendance.csv`` to check the two agree
+on the Email / Phone columns of real data and compare speed; the synthetic
+cases are in test_normalization.py.
+"""
+import argparse
+import os
+import re
+import time
+
+import pandas as pd
+
+
+def normalize_email(raw):
+    if pd.isna(raw) or raw is None:
+        return ""
+    return str(raw).strip().lower()
+
+
+def clean_phone(raw):
+    if pd.isna(raw) or raw is None:
+        return ""
+    s = str(raw).strip()
+    if s == "":
+        return ""
+    s = re.sub(r'\.0+$', '', s)
+    digits = re.sub(r'\D', '', s)
+    if digits == "":
+        return ""
+    if digits.startswith("60") and len(digits) > 2:
+        digits = "0" + digits[2:]
+    if not digits.startswith("0") and len(digits) == 9:
+        digits = "0" + digits
+    return digits
+
+
+def clean_contact_field(raw):
+    if pd.isna(raw) or raw is None:
+        return ""
+    s = str(raw).strip()
+    if s == "":
+        return ""
+    if "@" in s:
+        return s.lower()
+    return clean_phone(s)
+
+
+def normalize_identifier(identifier):
+    if pd.isna(identifier) or identifier is None:
+        return ""
+    s = str(identifier).strip()
+    if s == "":
+        return ""
+    if "@" in s:
+        return s.lower()
+    return clean_phone(s)
+
+
+# === Vectorized ===
+def _strings(values):
+    return pd.Series(values, dtype=object).fillna("").astype(str)
+
+
+def _per_value_if_non_ascii(strings, vectorized, scalar):
+    # pandas' Arrow string kernels differ from Python on some non-ASCII input
+    # (\d, case mapping), so those rare rows take the scalar path
+    result = vectorized(strings)
+    non_ascii = strings.str.contains(r"[^\x00-\x7f]", regex=True)
+    if non_ascii.any():
+        result[non_ascii] = strings[non_ascii].map(scalar)
+    return result
+
+
+def _lower(strings):
+    return _per_value_if_non_ascii(strings, lambda s: s.str.lower(), str.lower)
+
+
+def normalize_email_series(values):
+    return _lower(_strings(values).str.strip())
+
+
+def clean_phone_series(values):
+    stripped = _strings(values).str.strip().str.replace(r"\.0+$", "", regex=True)
+    digits = _per_value_if_non_ascii(stripped, lambda s: s.str.replace(r"\D", "", regex=True),
+                                     lambda s: re.sub(r"\D", "", s))
+    # Malaysian country code 60... becomes a local 0...
+    digits = digits.mask(digits.str.startswith("60") & (digits.str.len() > 2), "0" + digits.str.slice(2))
+    # 9 digits without the leading 0
+    digits = digits.mask(~digits.str.startswith("0") & (digits.str.len() == 9), "0" + digits)
+    return digits
+
+
+def normalize_identifier_series(values):
+    stripped = _strings(values).str.strip()
+    is_email = stripped.str.contains("@", regex=False)
+    result = clean_phone_series(stripped)
+    result[is_email] = _lower(stripped[is_email])
+    return result
+
+
+# === Equivalence check and benchmark ===
+def check(values):
+    """Rows where a vectorized function disagrees with its scalar version."""
+    values = pd.Series(values, dtype=object)
+    checks = [
+        ("normalize_email", values.map(normalize_email), normalize_email_series(values)),
+        ("clean_phone", values.map(clean_phone), clean_phone_series(values)),
+        ("normalize_identifier", values.map(normalize_identifier), normalize_identifier_series(values)),
+    ]
+    mismatches = []
+    for name, expected, actual in checks:
+        for value, e, a in zip(values, expected, actual):
+            if e != a:
+                mismatches.append((name, value, e, a))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check vectorized normalization against the scalar functions.")
+    parser.add_argument("files", nargs="*", default=["users.csv", "attendance.csv"],
+                        help="CSV files whose Email and Phone columns are checked")
+    args = parser.parse_args()
+
+    columns = []
+    for path in args.files:
+        if not os.path.exists(path):
+            print(f"Skipping {path}: not found")
+            continue
+        frame = pd.read_csv(path, dtype=str, keep_default_na=False)
+        columns += [frame[c] for c in ("Email", "Phone") if c in frame.columns]
+    values = pd.concat(columns, ignore_index=True) if columns else pd.Series([], dtype=object)
+
+    mismatches = check(values)
+    for name, value, expected, actual in mismatches[:20]:
+        print(f"MISMATCH {name}({value!r}): scalar {expected!r}, vectorized {actual!r}")
+    print(f"{len(values)} values checked, {len(mismatches)} mismatches")
+
+    start = time.perf_counter()
+    values.map(clean_phone)
+    scalar_s = time.perf_counter() - start
+    start = time.perf_counter()
+    clean_phone_series(values)
+    vector_s = time.perf_counter() - start
+    print(f"clean_phone: scalar {scalar_s:.3f}s, vectorized {vector_s:.3f}s ({scalar_s / max(vector_s, 1e-9):.1f}x)")
+    raise SystemExit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
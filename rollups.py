@@ -0,0 +1,120 @@
+"""Daily and monthly attendance rollups, kept current punch by punch.
+
+Two small tables summarize attendance so reports never rescan the history:
+
+    daily:   Org, Date, Present, Minutes, Open
+    monthly: Org, User ID, Month, Present, Minutes, Open
+
+Present counts shifts (a user has at most one per org and day), Minutes the
+time worked in closed shifts and Open the shifts still waiting for a
+clock-out. User ID is the storage identity, so rows from before User IDs roll
+up per email/phone.
+
+build() computes both from attendance rows in one vectorized pass;
+add_clock_in() / add_clock_out() apply a single punch. The CSV repository
+keeps them beside the rows in its attendance cache (built when the snapshot
+is read, then fed by journal events); SQLite stores them as tables updated
+in each punch's transaction.
+
+Run ``python rollups.py attendance.db`` to rebuild the SQLite tables from the
+attendance rows, e.g. after editing the database by hand.
+"""
+import argparse
+import math
+
+import pandas as pd
+
+import timesheet
+
+MEASURES = ["Present", "Minutes", "Open"]
+DAILY_COLUMNS = ["Date"] + MEASURES
+MONTHLY_COLUMNS = ["User ID", "Month"] + MEASURES
+
+
+def build(att):
+    """(daily, monthly) frames, with Org, for att whose User ID column holds identities."""
+    out_times = att["Clock Out Time"].astype(str)
+    frame = pd.DataFrame({
+        "Org": att["Org"].astype(str),
+        "User ID": att["User ID"].astype(str),
+        "Date": att["Clock In Date"].astype(str),
+        "Present": 1,
+        "Minutes": timesheet.shift_minutes(att["Time"], out_times).fillna(0).round(2),
+        "Open": (out_times == "").astype(int),
+    })
+    frame["Month"] = frame["Date"].str.slice(0, 7)
+    daily = frame.groupby(["Org", "Date"], sort=True)[MEASURES].sum().reset_index()
+    monthly = frame.groupby(["Org", "User ID", "Month"], sort=True)[MEASURES].sum().reset_index()
+    return daily, monthly
+
+
+# === In-memory form ===
+# {"daily": {org: {date: [present, minutes, open]}},
+#  "monthly": {org: {(user id, month): [present, minutes, open]}}}
+def index(daily, monthly):
+    rollups = {"daily": {}, "monthly": {}}
+    for org, date, *measures in daily[["Org", "Date"] + MEASURES].itertuples(index=False, name=None):
+        rollups["daily"].setdefault(org, {})[date] = measures
+    for org, user_id, month, *measures in monthly[["Org", "User ID", "Month"] + MEASURES].itertuples(index=False, name=None):
+        rollups["monthly"].setdefault(org, {})[(user_id, month)] = measures
+    return rollups
+
+
+def _add(totals, key, present=0, minutes=0.0, open_shifts=0):
+    measures = totals.setdefault(key, [0, 0.0, 0])
+    measures[0] += present
+    measures[1] = round(measures[1] + minutes, 2)
+    measures[2] += open_shifts
+
+
+def punch_minutes(time, clock_out_time):
+    minutes = timesheet.shift_minutes(pd.Series([time]), pd.Series([clock_out_time]))[0]
+    return 0.0 if math.isnan(minutes) else round(float(minutes), 2)
+
+
+def add_clock_in(rollups, org, user_id, date):
+    _add(rollups["daily"].setdefault(org, {}), date, present=1, open_shifts=1)
+    _add(rollups["monthly"].setdefault(org, {}), (user_id, date[:7]), present=1, open_shifts=1)
+
+
+def add_clock_out(rollups, org, user_id, date, time, clock_out_time):
+    minutes = punch_minutes(time, clock_out_time)
+    _add(rollups["daily"].setdefault(org, {}), date, minutes=minutes, open_shifts=-1)
+    _add(rollups["monthly"].setdefault(org, {}), (user_id, date[:7]), minutes=minutes, open_shifts=-1)
+
+
+def relabel(rollups, mapping):
+    """Move each old org's totals to its new name ({old: new}, all at once); merged orgs add up."""
+    for level in ("daily", "monthly"):
+        moved = {org: rollups[level].pop(org) for org in mapping if org in rollups[level]}
+        for old, totals in moved.items():
+            target = rollups[level].setdefault(mapping[old], {})
+            for key, measures in totals.items():
+                _add(target, key, *measures)
+
+
+def daily_frame(rollups, org, start_date=None, end_date=None):
+    rows = [(date, *measures) for date, measures in rollups["daily"].get(org, {}).items()
+            if (not start_date or date >= start_date) and (not end_date or date <= end_date)]
+    return pd.DataFrame(rows, columns=DAILY_COLUMNS).sort_values("Date", ignore_index=True)
+
+
+def monthly_frame(rollups, org, month=None):
+    rows = [(user_id, m, *measures) for (user_id, m), measures in rollups["monthly"].get(org, {}).items()
+            if not month or m == month]
+    return pd.DataFrame(rows, columns=MONTHLY_COLUMNS).sort_values(["Month", "User ID"], ignore_index=True)
+
+
+def main():
+    from storage import SqliteRepository
+
+    parser = argparse.ArgumentParser(description="Rebuild the attendance rollup tables of a SQLite database.")
+    parser.add_argument("database", nargs="?", default="attendance.db")
+    args = parser.parse_args()
+
+    daily, monthly = SqliteRepository(args.database).rebuild_rollups()
+    print(f"Rebuilt {len(daily)} daily and {len(monthly)} monthly rollup rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""Streaming roster import for the admin "Upload CSV to Replace Users" flow.
+
+The upload is read IMPORT_CHUNK_ROWS rows at a time. Each chunk is normalized
+with the vectorized helpers and validated. Only the accepted rows, already
+cut down to ROSTER_COLUMNS, and the rejected rows with their reasons are kept,
+so peak memory does not grow with the size of the raw file.
+"""
+import pandas as pd
+
+from normalization import clean_phone_series, normalize_email_series, normalize_identifier_series
+
+# The user columns a roster file provides; User IDs are assigned by the app
+ROSTER_COLUMNS = ["Email", "Phone", "Name", "Gender", "Age", "Address", "Org", "Role"]
+REQUIRED_COLUMNS = ["Name", "Org"]
+IMPORT_CHUNK_ROWS = 50_000
+EMAIL_PATTERN = r"^[^@\s]+@[^@\s]+\.[^@\s]+$"
+MIN_PHONE_DIGITS = 9
+MAX_PHONE_DIGITS = 15
+
+# Reject reasons
+MISSING_NAME = "missing name"
+MISSING_CONTACT = "missing email and phone"
+INVALID_EMAIL = "invalid email"
+INVALID_PHONE = "invalid phone"
+DUPLICATE_IN_FILE = "duplicate email/phone in file"
+DUPLICATE_EXISTING = "email/phone already registered in another org"
+
+
+class MissingColumnsError(ValueError):
+    pass
+
+
+class ImportResult:
+    def __init__(self):
+        self.total_rows = 0
+        self.skipped_rows = 0  # rows of other orgs when filtering to one org
+        self._seen_emails = set()
+        self._seen_phones = set()
+        self._accepted = []
+        self._rejected = []
+
+    @property
+    def accepted(self):
+        if not self._accepted:
+            return pd.DataFrame(columns=ROSTER_COLUMNS)
+        return pd.concat(self._accepted, ignore_index=True)
+
+    @property
+    def rejected(self):
+        """Rejected rows as uploaded, with the 1-based file row and the reasons."""
+        if not self._rejected:
+            return pd.DataFrame(columns=["Row", "Reason"])
+        return pd.concat(self._rejected, ignore_index=True)
+
+    @property
+    def accepted_rows(self):
+        return sum(len(chunk) for chunk in self._accepted)
+
+    @property
+    def rejected_rows(self):
+        return sum(len(chunk) for chunk in self._rejected)
+
+    def reject_report_csv(self):
+        return self.rejected.to_csv(index=False).encode("utf-8")
+
+
+def existing_identifiers(users, exclude_org=None):
+    # Normalized emails and phones already taken, e.g. by the orgs an import leaves untouched
+    if exclude_org is not None:
+        users = users[users["Org"] != exclude_org]
+    emails = set(normalize_identifier_series(users["Email"])) - {""}
+    phones = set(normalize_identifier_series(users["Phone"])) - {""}
+    return emails, phones
+
+
+def _add_reason(reasons, mask, reason):
+    first = mask & (reasons == "")
+    more = mask & ~first
+    reasons[first] = reason
+    reasons[more] = reasons[more] + "; " + reason
+    return reasons
+
+
+def _duplicates(values, valid, seen):
+    # Among valid rows, anything already accepted earlier in the file (this chunk or before)
+    candidates = values[valid & (values != "")]
+    dup = candidates.isin(seen) | candidates.duplicated()
+    return dup.reindex(values.index, fill_value=False)
+
+
+def _validate_chunk(chunk, first_row, org, taken_emails, taken_phones, result):
+    chunk = chunk.fillna("").astype(str)
+    for column in ROSTER_COLUMNS:
+        if column not in chunk.columns:
+            chunk[column] = ""
+    if org is not None:
+        keep = chunk["Org"] == org
+        result.skipped_rows += int((~keep).sum())
+        row_numbers = chunk.index[keep] + first_row
+        chunk = chunk[keep]
+    else:
+        row_numbers = chunk.index + first_row
+
+    email = normalize_email_series(chunk["Email"])
+    phone = clean_phone_series(chunk["Phone"])
+    name = chunk["Name"].str.strip()
+    reasons = pd.Series("", index=chunk.index, dtype=object)
+
+    reasons = _add_reason(reasons, name == "", MISSING_NAME)
+    reasons = _add_reason(reasons, (email == "") & (phone == ""), MISSING_CONTACT)
+    reasons = _add_reason(reasons, (email != "") & ~email.str.match(EMAIL_PATTERN), INVALID_EMAIL)
+    phone_len = phone.str.len()
+    reasons = _add_reason(reasons, (phone != "") & ((phone_len < MIN_PHONE_DIGITS) | (phone_len > MAX_PHONE_DIGITS)), INVALID_PHONE)
+    reasons = _add_reason(reasons, email.isin(taken_emails) | phone.isin(taken_phones), DUPLICATE_EXISTING)
+
+    # Within the file the first valid row wins; later rows sharing its email or phone are rejected
+    valid = reasons == ""
+    duplicate = _duplicates(email, valid, result._seen_emails) | _duplicates(phone, valid, result._seen_phones)
+    reasons = _add_reason(reasons, duplicate, DUPLICATE_IN_FILE)
+
+    ok = reasons == ""
+    result._seen_emails.update(email[ok & (email != "")])
+    result._seen_phones.update(phone[ok & (phone != "")])
+
+    accepted = chunk.loc[ok, ROSTER_COLUMNS].copy()
+    accepted["Email"] = email[ok]
+    accepted["Phone"] = phone[ok]
+    accepted["Name"] = name[ok]
+    result._accepted.append(accepted)
+    if (~ok).any():
+        rejected = chunk[~ok].copy()
+        rejected.insert(0, "Reason", reasons[~ok])
+        rejected.insert(0, "Row", row_numbers[(~ok).to_numpy()])
+        result._rejected.append(rejected)
+
+
+def import_roster(source, taken_emails=frozenset(), taken_phones=frozenset(), org=None, chunksize=IMPORT_CHUNK_ROWS):
+    """Stream a roster CSV into an ImportResult; org keeps only that org's rows."""
+    result = ImportResult()
+    first_row = 2  # row 1 of the file is the header
+    with pd.read_csv(source, dtype=str, chunksize=chunksize) as reader:
+        for chunk in reader:
+            missing = [c for c in REQUIRED_COLUMNS if c not in chunk.columns]
+            if not ({"Email", "Phone"} & set(chunk.columns)):
+                missing.append("Email or Phone")
+            if missing:
+                raise MissingColumnsError(missing)
+            chunk.index = pd.RangeIndex(len(chunk))
+            _validate_chunk(chunk, first_row, org, taken_emails, taken_phones, result)
+            result.total_rows += len(chunk)
+            first_row += len(chunk)
+    return result
+
+
+# === Diff against the current roster ===
+DIFF_COLUMNS = ["Email", "Phone", "Name", "Gender", "Age", "Address", "Role"]
+
+
+class RosterDiff:
+    def __init__(self, inserts, updates, deletes, unchanged, matches):
+        self.inserts = inserts      # new rows, ROSTER_COLUMNS
+        self.updates = updates      # "Label" of the current row, "Old Email"/"Old Phone", then ROSTER_COLUMNS
+        self.deletes = deletes      # current rows (by label) missing from the upload
+        self.unchanged = unchanged
+        self.matches = matches      # accepted row label -> label of the current row it matched
+
+    @property
+    def empty(self):
+        return self.inserts.empty and self.updates.empty and self.deletes.empty
+
+
+def diff_roster(current, accepted):
+    """Inserts / updates / deletes that turn current (one org's users) into accepted.
+
+    Rows are matched on normalized email, or on phone when the email does not
+    match, so a changed phone or email is an update rather than delete + insert.
+    """
+    current = current.fillna("").astype(str)
+    by_email = {}
+    by_phone = {}
+    for label, email, phone in zip(current.index, normalize_identifier_series(current["Email"]),
+                                   normalize_identifier_series(current["Phone"])):
+        if email:
+            by_email.setdefault(email, label)
+        if phone:
+            by_phone.setdefault(phone, label)
+
+    email_match = normalize_identifier_series(accepted["Email"]).map(by_email)
+    phone_match = normalize_identifier_series(accepted["Phone"]).map(by_phone)
+    labels = email_match.where(email_match.notna(), phone_match)
+    # Two upload rows matching the same current user: the first one keeps the match
+    labels = labels.where(~(labels.notna() & labels.duplicated()))
+
+    matched = labels.notna()
+    inserts = accepted[~matched].reset_index(drop=True)
+    candidates = accepted[matched].copy()
+    candidates.insert(0, "Label", labels[matched].astype(current.index.dtype))
+    old = current.loc[candidates["Label"], DIFF_COLUMNS].to_numpy()
+    changed = (candidates[DIFF_COLUMNS].to_numpy() != old).any(axis=1)
+    updates = candidates[changed].copy()
+    updates.insert(1, "Old Email", current.loc[updates["Label"], "Email"].to_numpy())
+    updates.insert(2, "Old Phone", current.loc[updates["Label"], "Phone"].to_numpy())
+    deletes = current.drop(index=candidates["Label"])
+    return RosterDiff(inserts, updates.reset_index(drop=True), deletes, int((~changed).sum()), candidates["Label"])
@@ -0,0 +1,207 @@
+"""Append buffer for the users / attendance tables.
+
+Appending one row at a time with ``pd.concat`` copies the whole table on every
+call. A RowBuffer keeps new rows as plain dicts, packs them into DataFrame
+chunks every ``chunk_size`` rows, and only concatenates everything into one
+frame when a view calls ``frame()``. With a ``schema`` (see schema.py), packed
+chunks and the materialized frame are kept in its compact column types.
+
+``RowBuffer.copy_on_write()`` wraps a frame shared between sessions: ``view()``
+reads it in place, and it is only copied once the buffer is written to.
+
+Run ``python row_buffer.py`` for a microbenchmark against the concat path.
+"""
+import argparse
+import time
+
+import pandas as pd
+
+DEFAULT_CHUNK_SIZE = 4096
+
+
+class RowBuffer:
+    def __init__(self, frame=None, columns=None, chunk_size=DEFAULT_CHUNK_SIZE, schema=None):
+        if frame is not None and not frame.index.equals(pd.RangeIndex(len(frame))):
+            frame = frame.reset_index(drop=True)
+        self.columns = list(columns if columns is not None else frame.columns)
+        self.chunk_size = chunk_size
+        self.schema = schema
+        self._frame = frame
+        self._shared = None
+        self._loader = None
+        self._base_updates = []
+        self._base_len = len(frame) if frame is not None else 0
+        self._chunks = []
+        self._chunk_rows = 0
+        self._tail = []
+
+    @classmethod
+    def lazy(cls, loader, length, columns, chunk_size=DEFAULT_CHUNK_SIZE, schema=None):
+        # The base frame is only produced by loader() the first time it is needed;
+        # loader() must return a frame of exactly `length` rows.
+        buffer = cls(columns=columns, chunk_size=chunk_size, schema=schema)
+        buffer._loader = loader
+        buffer._base_len = length
+        return buffer
+
+    @classmethod
+    def copy_on_write(cls, shared, columns, chunk_size=DEFAULT_CHUNK_SIZE, schema=None):
+        buffer = cls.lazy(shared.copy, len(shared), columns, chunk_size=chunk_size, schema=schema)
+        buffer._shared = shared
+        return buffer
+
+    def __len__(self):
+        return self._base_len + self._chunk_rows + len(self._tail)
+
+    @property
+    def pending(self):
+        return self._chunk_rows + len(self._tail)
+
+    def append(self, row):
+        # Returns the label the row will have in frame()
+        label = len(self)
+        self._tail.append({c: row.get(c, "") for c in self.columns})
+        if len(self._tail) >= self.chunk_size:
+            self._pack_tail()
+        return label
+
+    def extend(self, rows):
+        # Bulk append (e.g. a roster upload): returns the labels the rows will have
+        first = len(self)
+        self._tail.extend({c: row.get(c, "") for c in self.columns} for row in rows)
+        labels = list(range(first, len(self)))
+        if len(self._tail) >= self.chunk_size:
+            self._pack_tail()
+        return labels
+
+    def set_value(self, label, column, value):
+        if label < self._base_len:
+            if self._frame is None and self._loader is not None:
+                # Applied when the base is loaded, so an update alone never forces a load
+                self._base_updates.append((label, column, value))
+            else:
+                self._set_frame_value(self._load_base(), label, column, value)
+            return
+        offset = label - self._base_len
+        if offset >= self._chunk_rows:
+            self._tail[offset - self._chunk_rows][column] = value
+            return
+        for chunk in self._chunks:
+            if offset < len(chunk):
+                self._set_frame_value(chunk, chunk.index[offset], column, value)
+                return
+            offset -= len(chunk)
+
+    def view(self):
+        """Frame for reading only; a shared base is returned as is while nothing was written."""
+        if self._frame is None and self._shared is not None and not self.pending and not self._base_updates:
+            return self._shared
+        return self.frame()
+
+    def frame(self):
+        base = self._load_base()
+        if self.pending:
+            self._pack_tail()
+            pieces = [base] + self._chunks
+            if self.schema is not None and not self._same_types(pieces):
+                # A piece left as strings (unparseable values) must not be mixed with typed values
+                pieces = [self.schema.expand(piece) for piece in pieces]
+            base = pd.concat(pieces, ignore_index=True)
+            if self.schema is not None:
+                # Chunks carry their own categories; concat falls back to object for those
+                base = self.schema.compact(base)
+            self._frame = base
+            self._base_len = len(base)
+            self._chunks = []
+            self._chunk_rows = 0
+        return base
+
+    def _load_base(self):
+        if self._frame is None:
+            if self._loader is not None:
+                self._frame = self._loader()
+                self._loader = None
+                self._shared = None
+                for label, column, value in self._base_updates:
+                    self._set_frame_value(self._frame, label, column, value)
+                self._base_updates = []
+            else:
+                self._frame = pd.DataFrame(columns=self.columns)
+        return self._frame
+
+    @staticmethod
+    def _same_types(pieces):
+        def kinds(frame):
+            return ["category" if isinstance(t, pd.CategoricalDtype) else str(t) for t in frame.dtypes]
+        first = kinds(pieces[0])
+        return all(kinds(piece) == first for piece in pieces[1:])
+
+    def _set_frame_value(self, frame, label, column, value):
+        if self.schema is not None:
+            self.schema.assign(frame, label, column, value)
+        else:
+            frame.at[label, column] = value
+
+    def _pack_tail(self):
+        if self._tail:
+            chunk = pd.DataFrame(self._tail, columns=self.columns)
+            self._chunks.append(self.schema.compact(chunk) if self.schema is not None else chunk)
+            self._chunk_rows += len(self._tail)
+            self._tail = []
+
+
+# === Microbenchmark ===
+BENCH_COLUMNS = ["Email", "Phone", "Name", "Org", "Clock In Date", "Time", "Clock Out Time"]
+
+
+def _bench_row(i):
+    return {
+        "Email": f"user{i}@example.com",
+        "Phone": f"01{i % 100000000:08d}",
+        "Name": f"User {i}",
+        "Org": f"Org {i % 50}",
+        "Clock In Date": "2024-01-01",
+        "Time": "08:00:00",
+        "Clock Out Time": "",
+    }
+
+
+def _bench_base(size):
+    return pd.DataFrame([_bench_row(i) for i in range(size)], columns=BENCH_COLUMNS)
+
+
+def bench_concat(base, appends):
+    df = base
+    start = time.perf_counter()
+    for i in range(appends):
+        df = pd.concat([df, pd.DataFrame([_bench_row(i)])], ignore_index=True)
+    return time.perf_counter() - start
+
+
+def bench_buffer(base, appends):
+    start = time.perf_counter()
+    buffer = RowBuffer(base)
+    for i in range(appends):
+        buffer.append(_bench_row(i))
+    buffer.frame()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-row pd.concat with RowBuffer appends.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="existing table sizes to append onto")
+    parser.add_argument("--appends", type=int, default=1_000,
+                        help="rows appended per run (e.g. one day of punches)")
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'appends':>8} {'concat (s)':>12} {'buffer (s)':>12} {'speedup':>8}")
+    for size in args.sizes:
+        base = _bench_base(size)
+        concat_s = bench_concat(base, args.appends)
+        buffer_s = bench_buffer(base, args.appends)
+        print(f"{size:>10} {args.appends:>8} {concat_s:>12.3f} {buffer_s:>12.3f} {concat_s / buffer_s:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
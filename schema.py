@@ -0,0 +1,209 @@
+"""Compact in-memory column types for the users and attendance frames.
+
+On disk every column is a string. In memory, repeated labels become
+categoricals, Clock In Date becomes datetime64, clock times become
+seconds-since-midnight integers and Age becomes a nullable integer. expand()
+turns a frame back into strings; call it only at the CSV / download boundary.
+
+A column whose values do not all parse (e.g. a free-text Age) is left as
+strings rather than losing data.
+
+Run ``python schema.py`` to compare memory use of the string and compact
+layouts for users.csv and attendance.csv.
+"""
+import argparse
+import re
+
+import numpy as np
+import pandas as pd
+
+CATEGORY = "category"
+DATE = "date"
+TIME = "time"
+INTEGER = "integer"
+
+DATE_FORMAT = "%Y-%m-%d"
+INTEGER_PATTERN = r"-?[1-9][0-9]{0,8}|0"
+
+
+def _is_typed(series, kind):
+    if kind == CATEGORY:
+        return isinstance(series.dtype, pd.CategoricalDtype)
+    if kind == DATE:
+        return pd.api.types.is_datetime64_any_dtype(series)
+    return pd.api.types.is_integer_dtype(series)
+
+
+def _parse(values, kind):
+    # Returns the typed column, or None if any non-empty value does not parse
+    strings = values.fillna("").astype(str)
+    present = strings != ""
+    if kind == DATE:
+        parsed = pd.to_datetime(strings.where(present), format=DATE_FORMAT, errors="coerce")
+    elif kind == TIME:
+        # Clock times repeat a lot, so each distinct value is parsed once
+        codes, distinct = pd.factorize(strings.where(present))
+        distinct = pd.to_timedelta(pd.Series(distinct, dtype=object), errors="coerce").dt.total_seconds()
+        seconds = pd.Series(np.append(distinct.to_numpy(), np.nan)[codes], index=strings.index)
+        if (seconds % 1 > 0).any():  # fractional seconds do not fit the integer column
+            return None
+        parsed = seconds.astype("Int32")
+    else:
+        # Only plain integers that fit Int32 and print back unchanged: "25.5",
+        # "1e3" or "030" keep the column as strings
+        if not strings[present].str.fullmatch(INTEGER_PATTERN).all():
+            return None
+        parsed = pd.to_numeric(strings.where(present)).astype("Int32")
+    if (present & parsed.isna()).any():
+        return None
+    return parsed
+
+
+def _format_times(seconds):
+    # Each distinct value is formatted once, then gathered; missing values become ""
+    codes, distinct = pd.factorize(seconds)
+    text = [f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in distinct.tolist()]
+    return pd.Series(np.array(text + [""], dtype=object)[codes], index=seconds.index).astype(str)
+
+
+def _parse_value(value, kind):
+    # Raises ValueError for a value the typed column cannot hold, by _parse()'s rules
+    if value is None or value == "" or (not isinstance(value, str) and pd.isna(value)):
+        return pd.NaT if kind == DATE else pd.NA
+    if kind == DATE:
+        return pd.to_datetime(value, format=DATE_FORMAT)
+    if kind == TIME:
+        seconds = pd.to_timedelta(value).total_seconds()
+        if seconds % 1:
+            raise ValueError(f"Fractional seconds in {value!r}")
+        return int(seconds)
+    if re.fullmatch(INTEGER_PATTERN, str(value)) is None:
+        raise ValueError(f"Not a plain integer: {value!r}")
+    return int(value)
+
+
+def _strings(values, kind):
+    # A typed column back as strings, as stored
+    if kind == CATEGORY:
+        return values.astype(object).fillna("").astype(str)
+    if kind == DATE:
+        return values.dt.strftime(DATE_FORMAT).fillna("").astype(str)
+    if kind == TIME:
+        return _format_times(values.astype("Int64"))
+    return values.astype(object).where(values.notna(), "").astype(str)
+
+
+class Schema:
+    def __init__(self, columns, kinds):
+        self.columns = list(columns)
+        self.kinds = dict(kinds)
+
+    def compact(self, frame):
+        """Typed copy of frame; already-typed columns are kept (categoricals re-unified)."""
+        frame = frame.copy()
+        for column, kind in self.kinds.items():
+            if column not in frame.columns:
+                continue
+            if kind == CATEGORY:
+                values = frame[column]
+                if not _is_typed(values, CATEGORY):
+                    values = values.fillna("").astype(str)
+                frame[column] = values.astype("category")
+            elif not _is_typed(frame[column], kind):
+                parsed = _parse(frame[column], kind)
+                if parsed is not None:
+                    frame[column] = parsed
+        return frame
+
+    def expand(self, frame):
+        """All-string copy of frame, as stored in the CSV files."""
+        frame = frame.copy()
+        for column, kind in self.kinds.items():
+            if column in frame.columns and _is_typed(frame[column], kind):
+                frame[column] = _strings(frame[column], kind)
+        return frame
+
+    def assign(self, frame, rows, column, value):
+        """frame.loc[rows, column] = value for a string value (or one per row), in whatever type the column has."""
+        kind = self.kinds.get(column)
+        if kind is not None and _is_typed(frame[column], kind):
+            scalar = isinstance(value, str) or not pd.api.types.is_list_like(value)
+            values = [value] if scalar else list(value)
+            if kind == CATEGORY:
+                missing = pd.Index(pd.unique(pd.Series(values, dtype=object))).difference(frame[column].cat.categories)
+                if len(missing):
+                    frame[column] = frame[column].cat.add_categories(list(missing))
+            else:
+                try:
+                    parsed = [_parse_value(v, kind) for v in values]
+                except (TypeError, ValueError):
+                    # A value the type cannot hold (e.g. Age "30.0"): the column
+                    # goes back to strings, as compact() leaves such columns
+                    frame[column] = _strings(frame[column], kind)
+                else:
+                    value = parsed[0] if scalar else parsed
+        frame.loc[rows, column] = value
+
+    def relabel(self, frame, column, mapping):
+        """Replace values of column per mapping ({old: new}) in place.
+
+        On a categorical column this touches only the categories: renames to
+        unused names are a relabel of the category table, and merges are one
+        remap of the integer codes.
+        """
+        values = frame[column]
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            frame[column] = values.replace(mapping)
+            return
+        categories = values.cat.categories
+        mapping = {old: new for old, new in mapping.items() if old in categories and old != new}
+        if not mapping:
+            return
+        targets = list(mapping.values())
+        if len(set(targets)) == len(targets) and not set(targets) & (set(categories) - set(mapping)):
+            frame[column] = values.cat.rename_categories(mapping)
+            return
+        new_categories = pd.Index(pd.unique(pd.Series([mapping.get(c, c) for c in categories], dtype=object)))
+        remap = new_categories.get_indexer([mapping.get(c, c) for c in categories])
+        codes = values.cat.codes.to_numpy()
+        new_codes = np.where(codes >= 0, remap[codes], -1)
+        frame[column] = pd.Categorical.from_codes(new_codes, new_categories)
+
+    def memory_report(self, frame):
+        """Deep memory use per column for the string layout vs the compact one."""
+        strings = self.expand(frame)
+        compact = self.compact(frame)
+        report = pd.DataFrame({
+            "Strings (bytes)": strings.memory_usage(index=False, deep=True),
+            "Compact (bytes)": compact.memory_usage(index=False, deep=True),
+        })
+        report.loc["Total"] = report.sum()
+        report["Ratio"] = (report["Strings (bytes)"] / report["Compact (bytes)"]).round(1)
+        return report
+
+
+USERS_SCHEMA = Schema(
+    ["Email", "Phone", "Name", "Gender", "Age", "Address", "Org", "Role", "User ID"],
+    {"Gender": CATEGORY, "Age": INTEGER, "Org": CATEGORY, "Role": CATEGORY},
+)
+ATTENDANCE_SCHEMA = Schema(
+    ["Email", "Phone", "Name", "Org", "Clock In Date", "Time", "Clock Out Time", "User ID"],
+    {"Name": CATEGORY, "Org": CATEGORY, "Clock In Date": DATE, "Time": TIME, "Clock Out Time": TIME},
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare memory use of the string and compact frame layouts.")
+    parser.add_argument("--users", default="users.csv")
+    parser.add_argument("--attendance", default="attendance.csv")
+    args = parser.parse_args()
+
+    for path, schema in ((args.users, USERS_SCHEMA), (args.attendance, ATTENDANCE_SCHEMA)):
+        frame = pd.read_csv(path, dtype=str).fillna("")
+        print(f"{path} ({len(frame)} rows)")
+        print(schema.memory_report(frame).to_string())
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1598 @@
+"""Storage backends for users, attendance, organizations and org admin passwords.
+
+The app only talks to a Repository. CsvRepository keeps the original CSV files
+(plus the append-only clock-in/out journal, and optionally a Parquet attendance
+snapshot, see attendance_parquet.py); SqliteRepository keeps everything
+in one embedded SQLite database in WAL mode.
+
+Frames handed out by load_users() are shared between sessions and must not be
+mutated; attendance_snapshot() returns a private, lazily loaded copy.
+
+Writers from any session or worker process serialize on the repository's
+DataLock. versions() returns a stamp per table so a session can tell whether
+the copy it is about to save is still the latest one.
+"""
+import csv
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: the lock only covers threads of this process
+    fcntl = None
+
+import pandas as pd
+
+import attendance_parquet
+import rollups
+from normalization import clean_phone_series, normalize_email_series, normalize_identifier, normalize_identifier_series
+from row_buffer import RowBuffer
+from schema import ATTENDANCE_SCHEMA
+
+USER_COLUMNS = ["Email", "Phone", "Name", "Gender", "Age", "Address", "Org", "Role", "User ID"]
+ATTENDANCE_COLUMNS = ["Email", "Phone", "Name", "Org", "Clock In Date", "Time", "Clock Out Time", "User ID"]
+# A shift is (identity, Org, Clock In Date); see user_identity()
+SHIFT_KEY_COLUMNS = ["User ID", "Org", "Clock In Date"]
+
+# Table names, as used by versions() and the app's dirty tracking
+USERS_TABLE = "users"
+ATTENDANCE_TABLE = "attendance"
+ORGS_TABLE = "organizations"
+ORG_PASSWORDS_TABLE = "org_passwords"
+TABLES = (USERS_TABLE, ATTENDANCE_TABLE, ORGS_TABLE, ORG_PASSWORDS_TABLE)
+
+LOCK_TIMEOUT = 30  # seconds to wait for another writer before giving up
+LOCK_RETRY_INTERVAL = 0.05
+
+# Outcomes of Repository.clock_out()
+CLOCKED_OUT = "clocked_out"
+NO_ACTIVE_CLOCK_IN = "no_active_clock_in"
+ALREADY_CLOCKED_OUT = "already_clocked_out"
+
+# Single-row writes batched by Repository.apply_writes() (see group_commit.py)
+ADD_USER = "add_user"
+CLOCK_IN = "clock_in"
+CLOCK_OUT = "clock_out"
+
+
+# === File helpers ===
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def stage_write(path, write, binary=False):
+    # Write the new content to a temp file next to path and return its name;
+    # os.replace(tmp_path, path) then swaps it in
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with (os.fdopen(fd, "wb") if binary else os.fdopen(fd, "w", encoding="utf-8", newline="")) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return tmp_path
+
+
+def atomic_write(path, write, binary=False):
+    # Write to a temp file in the same directory, then rename over the target,
+    # so readers only ever see the old or the new complete file
+    tmp_path = stage_write(path, write, binary)
+    try:
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def truncate_file(path, length):
+    # Back to length bytes (None: the file did not exist), e.g. to undo a failed append
+    if length is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    if os.path.exists(path) and os.path.getsize(path) > length:
+        with open(path, "r+b") as f:
+            f.truncate(length)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def atomic_write_csv(df, path):
+    atomic_write(path, lambda f: df.to_csv(f, index=False))
+
+
+# === Write lock ===
+class LockTimeout(Exception):
+    pass
+
+
+class DataLock:
+    # Re-entrant within a thread. Threads of one process queue on the RLock; processes
+    # queue on an advisory flock of lock_file, polled until LOCK_TIMEOUT expires.
+    def __init__(self, lock_file, timeout=LOCK_TIMEOUT):
+        self.lock_file = lock_file
+        self.timeout = timeout
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._owner = None
+        self._fd = None
+
+    def held_by_current_thread(self):
+        return self._owner == threading.get_ident()
+
+    def acquire(self):
+        if not self._thread_lock.acquire(timeout=self.timeout):
+            raise LockTimeout(f"Timed out waiting for {self.lock_file}")
+        if self._depth == 0 and fcntl is not None:
+            try:
+                self._fd = self._lock_file()
+            except BaseException:
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        self._owner = threading.get_ident()
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+        if self._depth == 0 and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+    def _lock_file(self):
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    raise LockTimeout(f"Timed out waiting for {self.lock_file}")
+                time.sleep(LOCK_RETRY_INTERVAL)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# === User identifier index ===
+# Normalized email / phone -> row label of the users frame, so login and
+# duplicate checks are dict lookups instead of a normalize-and-scan of every user.
+def new_user_index():
+    return {"email": {}, "phone": {}}
+
+
+def add_to_user_index(index, label, email, phone):
+    email_norm = normalize_identifier(email)
+    phone_norm = normalize_identifier(phone)
+    if email_norm:
+        index["email"].setdefault(email_norm, label)
+    if phone_norm:
+        index["phone"].setdefault(phone_norm, label)
+
+
+def remove_from_user_index(index, label, email, phone):
+    for field, value in (("email", email), ("phone", phone)):
+        norm = normalize_identifier(value)
+        if norm and index[field].get(norm) == label:
+            del index[field][norm]
+
+
+def claim_user_identifiers(index, pending, row):
+    """True, reserving row's email/phone in pending, unless a user in index or pending already has one of them."""
+    ids = {"email": normalize_identifier(row.get("Email") or ""), "phone": normalize_identifier(row.get("Phone") or "")}
+    if any(value and (value in index[field] or value in pending[field]) for field, value in ids.items()):
+        return False
+    for field, value in ids.items():
+        if value:
+            pending[field].add(value)
+    return True
+
+
+def build_user_index(users):
+    index = new_user_index()
+    emails = normalize_identifier_series(users["Email"])
+    phones = normalize_identifier_series(users["Phone"])
+    for label, email_norm, phone_norm in zip(users.index, emails, phones):
+        if email_norm:
+            index["email"].setdefault(email_norm, label)
+        if phone_norm:
+            index["phone"].setdefault(phone_norm, label)
+    return index
+
+
+# === User IDs ===
+# Attendance rows reference their user by User ID. The Email/Phone/Name they
+# also carry are the values at punch time; views show the current ones (see
+# Repository.current_user_details). Rows without an ID, i.e. journal events from
+# before the migration or rows whose user is gone, are told apart by those
+# contact details instead.
+def new_user_id():
+    return uuid.uuid4().hex[:16]
+
+
+def user_identity(user_id, email, phone):
+    return user_id or f"legacy:{email}:{phone}"
+
+
+def identity_series(att):
+    return att["User ID"].where(att["User ID"] != "", "legacy:" + att["Email"] + ":" + att["Phone"])
+
+
+def assign_user_ids(users, att):
+    """(users, att, users changed, att changed) with an ID on every user, and on every
+    attendance row whose ID is missing or unknown but whose Email (else Phone) and Org
+    match a user."""
+    users = users.copy()
+    missing = users["User ID"] == ""
+    users.loc[missing, "User ID"] = [new_user_id() for _ in range(int(missing.sum()))]
+
+    orphaned = ~att["User ID"].isin(set(users["User ID"]))
+    if not orphaned.any():
+        return users, att, bool(missing.any()), False
+    att = att.copy()
+    ids = pd.Series("", index=att.index[orphaned], dtype=object)
+    for column in ("Phone", "Email"):  # Email matches win over Phone ones
+        known = users[users[column] != ""].drop_duplicates([column, "Org"])
+        lookup = dict(zip(known[column] + "\x1f" + known["Org"], known["User ID"]))
+        rows = att.loc[orphaned]
+        found = (rows[column] + "\x1f" + rows["Org"]).map(lookup)
+        ids = ids.where(found.isna() | (rows[column] == ""), found)
+    matched = ids != ""
+    att.loc[ids.index[matched], "User ID"] = ids[matched]
+    return users, att, bool(missing.any()), bool(matched.any())
+
+
+# === Shift index ===
+# (identity, Org, Clock In Date) -> row label, plus the shifts still waiting
+# for a clock-out (-> their clock-in Time), so punches never scan history.
+def new_shift_index():
+    return {"rows": {}, "open": {}}
+
+
+def shift_key(user, date):
+    identity = user_identity(user.get("User ID") or "", user.get("Email") or "", user.get("Phone") or "")
+    return (identity, user.get("Org") or "", date)
+
+
+def row_shift_key(row):
+    return (user_identity(row["User ID"], row["Email"], row["Phone"]), row["Org"], row["Clock In Date"])
+
+
+def add_to_shift_index(shifts, label, key, clock_in_time, clock_out_time):
+    if key in shifts["rows"]:
+        return
+    shifts["rows"][key] = label
+    if not clock_out_time:
+        shifts["open"][key] = clock_in_time
+
+
+def build_shift_index(att):
+    # Column-wise; as in add_to_shift_index, the first row of a key wins
+    keys = pd.DataFrame({"identity": identity_series(att), "Org": att["Org"], "Clock In Date": att["Clock In Date"]})
+    first = ~keys.duplicated().to_numpy()
+    is_open = first & (att["Clock Out Time"] == "").to_numpy()
+
+    def tuples(mask):
+        return zip(*(keys[column][mask].tolist() for column in keys.columns))
+
+    return {
+        "rows": dict(zip(tuples(first), att.index[first].tolist())),
+        "open": dict(zip(tuples(is_open), att["Time"][is_open].tolist())),
+    }
+
+
+def relabel_shift_index(shifts, mapping):
+    # Keys moved to the new org names ({old: new}); where a merge makes two rows
+    # share a key, the first row wins, as in build_shift_index
+    rows, opened = {}, {}
+    for key, label in shifts["rows"].items():
+        new_key = (key[0], mapping.get(key[1], key[1]), key[2])
+        if rows.get(new_key, label) < label:
+            continue
+        rows[new_key] = label
+        if key in shifts["open"]:
+            opened[new_key] = shifts["open"][key]
+        else:
+            opened.pop(new_key, None)
+    shifts["rows"], shifts["open"] = rows, opened
+
+
+def build_rollups(att):
+    """rollups.build() for attendance rows, rolled up per identity."""
+    return rollups.build(att.assign(**{"User ID": identity_series(att)}))
+
+
+# === Org partitions ===
+# Org -> row labels of a table, so per-org reads do not filter the whole table
+def build_org_partitions(frame):
+    return {org: list(labels) for org, labels in frame.groupby("Org", sort=False).indices.items()}
+
+
+def relabel_org_partitions(partitions, mapping):
+    moved = {org: partitions.pop(org) for org in mapping if org in partitions}
+    for old, labels in moved.items():
+        partitions.setdefault(mapping[old], []).extend(labels)
+    for new in {mapping[old] for old in moved}:
+        partitions[new].sort()
+
+
+# === Personal history index ===
+# (identity, Org) -> that person's row labels in (Clock In Date, Time) order.
+# Punches almost always arrive in time order, so appends stay sorted; an
+# out-of-order one only flags the list to be re-sorted on its next read.
+def build_history_index(att):
+    ordered = att.sort_values(["Clock In Date", "Time"], kind="stable")
+    labels = ordered.index.to_numpy()
+    dates = ordered["Clock In Date"].to_numpy()
+    times = ordered["Time"].to_numpy()
+    history = {}
+    for key, positions in ordered.groupby([identity_series(ordered), ordered["Org"]], sort=False).indices.items():
+        last = positions[-1]
+        history[key] = {"labels": labels[positions].tolist(), "last": (dates[last], times[last]), "sorted": True}
+    return history
+
+
+def add_to_history_index(history, label, row):
+    key = (user_identity(row["User ID"], row["Email"], row["Phone"]), row["Org"])
+    person = history.setdefault(key, {"labels": [], "last": ("", ""), "sorted": True})
+    order_key = (row["Clock In Date"], row["Time"])
+    if order_key < person["last"]:
+        person["sorted"] = False
+    else:
+        person["last"] = order_key
+    person["labels"].append(label)
+
+
+def relabel_history_index(history, mapping):
+    moved = {key: history.pop(key) for key in [key for key in history if key[1] in mapping]}
+    for (identity, org), person in moved.items():
+        other = history.setdefault((identity, mapping[org]), person)
+        if other is not person:
+            # A merge: re-sorted on the next read, ties in label order as in build_history_index
+            other["labels"] = sorted(other["labels"] + person["labels"])
+            other["last"] = max(other["last"], person["last"])
+            other["sorted"] = False
+
+
+def history_page(att, month=None, offset=0, limit=31):
+    """(page newest first, total rows, months newest first) of one person's att sorted oldest first."""
+    dates = att["Clock In Date"].astype(str)
+    months = sorted(set(dates.str.slice(0, 7)) - {""}, reverse=True)
+    if month:
+        att = att[dates.str.startswith(month)]
+    newest_first = att.iloc[::-1]
+    return newest_first.iloc[offset:offset + limit], len(att), months
+
+
+# === Attendance pages ===
+# Attendance columns that views take from the users table by User ID
+USER_DETAIL_COLUMNS = ["Email", "Phone", "Name"]
+# Columns the admin attendance grid can sort by; a sort on the date also orders by Time
+ATTENDANCE_SORT_COLUMNS = ["Clock In Date", "Time", "Clock Out Time", "Name", "Email", "Phone"]
+
+
+def attendance_sort_keys(sort_by):
+    return ["Clock In Date", "Time"] if sort_by == "Clock In Date" else [sort_by]
+
+
+def attendance_page(att, start_date=None, end_date=None, name="", open_only=False,
+                    sort_by="Clock In Date", descending=True, offset=0, limit=50):
+    """(rows offset..offset+limit of the filtered and sorted att, total matching rows).
+
+    att may be all strings or in ATTENDANCE_SCHEMA's compact types; the page keeps them.
+    """
+    mask = pd.Series(True, index=att.index)
+    if start_date:
+        mask &= att["Clock In Date"] >= start_date
+    if end_date:
+        mask &= att["Clock In Date"] <= end_date
+    if name:
+        mask &= att["Name"].str.contains(name, case=False, regex=False)
+    if open_only:
+        clock_out = att["Clock Out Time"]
+        mask &= clock_out.isna() if pd.api.types.is_integer_dtype(clock_out) else clock_out == ""
+    matched = att[mask]
+    total = len(matched)
+    if total == 0:
+        return matched, 0
+    # Sorting positions, not the frame, keeps the gather down to the one page
+    order = matched[attendance_sort_keys(sort_by)].reset_index(drop=True)
+    # Missing typed values go where "" would sort among strings
+    order = order.sort_values(order.columns.tolist(), ascending=not descending, kind="stable",
+                              na_position="last" if descending else "first").index
+    return matched.take(order[offset:offset + limit]), total
+
+
+# === Whole-table frames (backups) ===
+def organizations_frame(organizations):
+    return pd.DataFrame({"Org": list(organizations)}, columns=["Org"], dtype=str)
+
+
+def org_passwords_frame(passwords):
+    return pd.DataFrame(list(passwords.items()), columns=["Org", "Password"], dtype=str)
+
+
+def frame_organizations(frame):
+    return [org for org in frame["Org"].fillna("").astype(str) if org.strip()]
+
+
+def frame_org_passwords(frame):
+    frame = frame.fillna("").astype(str)
+    return dict(zip(frame["Org"], frame["Password"]))
+
+
+def relabel_organizations(organizations, mapping):
+    # The org list after a relabel ({old: new}), in order, each org once
+    relabeled = []
+    for org in organizations:
+        org = mapping.get(org, org)
+        if org not in relabeled:
+            relabeled.append(org)
+    return relabeled
+
+
+def relabel_org_passwords(passwords, mapping):
+    # A renamed org keeps its admin password; a merged-away one's is dropped
+    passwords = dict(passwords)
+    moved = {old: passwords.pop(old) for old in mapping if old in passwords}
+    for old, password in moved.items():
+        passwords.setdefault(mapping[old], password)
+    return passwords
+
+
+# === Repository interface ===
+class Repository:
+    lock = None  # DataLock shared by every writer of this data
+
+    def write_lock(self):
+        """Hold while reading, modifying and saving tables so no other writer interleaves."""
+        return self.lock
+
+    def versions(self):
+        """A stamp per table in TABLES that changes whenever the stored table changes."""
+        raise NotImplementedError
+
+    def load_users(self):
+        """Return the shared (users frame, user index); callers must not mutate them."""
+        raise NotImplementedError
+
+    def attendance_snapshot(self):
+        """Return a private RowBuffer of all attendance rows, loaded on first use."""
+        raise NotImplementedError
+
+    def load_organizations(self):
+        raise NotImplementedError
+
+    def load_org_passwords(self):
+        raise NotImplementedError
+
+    def save_users(self, users):
+        raise NotImplementedError
+
+    def save_attendance(self, attendance):
+        raise NotImplementedError
+
+    def save_organizations(self, organizations):
+        raise NotImplementedError
+
+    def save_org_passwords(self, passwords):
+        raise NotImplementedError
+
+    def export_tables(self):
+        """Every table as an all-string frame, keyed by table name (call under write_lock())."""
+        return {
+            USERS_TABLE: self.load_users()[0],
+            ATTENDANCE_TABLE: self.attendance_snapshot().frame(),
+            ORGS_TABLE: organizations_frame(self.load_organizations()),
+            ORG_PASSWORDS_TABLE: org_passwords_frame(self.load_org_passwords()),
+        }
+
+    def save_tables(self, tables):
+        """Replace some or all tables, as one change; frames shaped as by export_tables()."""
+        raise NotImplementedError
+
+    def relabel_orgs(self, mapping):
+        """Move users, attendance, the org list and passwords from each old org to its new name
+        ({old: new}, applied all at once), as one change; call under write_lock()."""
+        raise NotImplementedError
+
+    def add_user(self, row):
+        raise NotImplementedError
+
+    def clock_in(self, row):
+        """Record a clock-in; False if that shift (identity, org, date) already exists."""
+        return self.apply_writes([(CLOCK_IN, (row,))])[0]
+
+    def clock_out(self, key, clock_out_time):
+        """Close the shift for key; returns CLOCKED_OUT, NO_ACTIVE_CLOCK_IN or ALREADY_CLOCKED_OUT."""
+        return self.apply_writes([(CLOCK_OUT, (key, clock_out_time))])[0]
+
+    def apply_writes(self, writes):
+        """Apply [(op, args)] of ADD_USER (row), CLOCK_IN (row) and CLOCK_OUT (key, time) in order,
+        as one all-or-nothing durable write; returns each one's result.
+
+        ADD_USER returns False, without adding, when the email or phone is already registered.
+        """
+        raise NotImplementedError
+
+    def user_attendance(self, user_id, org):
+        """One user's attendance rows for an org, newest first."""
+        raise NotImplementedError
+
+    def org_attendance(self, org):
+        raise NotImplementedError
+
+    def org_attendance_page(self, org, **filters):
+        """One page of an org's attendance and the total row count; filters as for attendance_page()."""
+        att = self.org_attendance(org)
+        if filters.get("name") or filters.get("sort_by") in USER_DETAIL_COLUMNS:
+            # Filtering or sorting on user details needs the current ones for every row
+            return attendance_page(self.current_user_details(att), **filters)
+        page, total = attendance_page(att, **filters)
+        return self.current_user_details(page), total
+
+    def user_attendance_page(self, user_id, org, month=None, offset=0, limit=31):
+        """(page newest first, total rows, months "YYYY-MM" newest first) of one user's attendance."""
+        page, total, months = history_page(self.user_attendance(user_id, org).iloc[::-1], month, offset, limit)
+        return self.current_user_details(page), total, months
+
+    def org_daily_rollup(self, org, start_date=None, end_date=None):
+        """Per-day Present / Minutes / Open for an org (rollups.DAILY_COLUMNS), oldest first."""
+        raise NotImplementedError
+
+    def org_monthly_rollup(self, org, month=None):
+        """Per-user, per-month Present / Minutes / Open for an org (rollups.MONTHLY_COLUMNS)."""
+        raise NotImplementedError
+
+    def rebuild_rollups(self):
+        """Recompute the rollups from the attendance rows; returns the (daily, monthly) frames."""
+        raise NotImplementedError
+
+    _users_by_id = None
+
+    def current_user_details(self, att):
+        """att with Email/Phone/Name taken from each row's user, where that user still exists."""
+        users = self.load_users()[0]
+        cached = self._users_by_id
+        if cached is None or cached[0] is not users:
+            known = users[users["User ID"] != ""].drop_duplicates("User ID")
+            cached = self._users_by_id = (users, known.set_index("User ID")[USER_DETAIL_COLUMNS])
+        by_id = cached[1]
+        found = att["User ID"].isin(by_id.index)
+        if not found.any():
+            return att
+        att = att.copy()
+        current = by_id.loc[att.loc[found, "User ID"]]
+        for column in USER_DETAIL_COLUMNS:
+            att.loc[found, column] = current[column].to_numpy()
+        return att
+
+    def migrate_user_ids(self):
+        """Give users without one a User ID and link attendance rows to their users; True if anything was saved."""
+        with self.lock:
+            users = self.load_users()[0]
+            att = self.attendance_snapshot().frame()
+            users, att, users_changed, att_changed = assign_user_ids(users, att)
+            tables = {}
+            if users_changed:
+                tables[USERS_TABLE] = users
+            if att_changed:
+                tables[ATTENDANCE_TABLE] = att
+            if tables:
+                self.save_tables(tables)
+            return bool(tables)
+
+    def org_users(self, org):
+        users = self.load_users()[0]
+        return users[users["Org"] == org]
+
+
+# === CSV backend ===
+JOURNAL_COLUMNS = ["Event"] + ATTENDANCE_COLUMNS
+JOURNAL_COMPACT_BYTES = 256 * 1024
+
+
+def parse_users_file(path):
+    users = pd.read_csv(path, dtype=str).fillna("")
+    # ensure columns exist
+    for c in USER_COLUMNS:
+        if c not in users.columns:
+            users[c] = ""
+    users["Email"] = normalize_email_series(users["Email"])
+    users["Phone"] = clean_phone_series(users["Phone"])
+    return users[USER_COLUMNS].copy()
+
+
+def parse_users_with_index(path):
+    users = parse_users_file(path)
+    return users, build_user_index(users)
+
+
+def parse_attendance_file(path):
+    return parse_attendance_frame(pd.read_csv(path, dtype=str))
+
+
+def parse_attendance_frame(att):
+    # The attendance columns as read back from a snapshot: strings, normalized contacts
+    att = att.astype(str).where(att.notna(), "")
+    for col in ATTENDANCE_COLUMNS:
+        if col not in att.columns:
+            att[col] = ""
+    att["Email"] = normalize_email_series(att["Email"])
+    att["Phone"] = clean_phone_series(att["Phone"])
+    return att[ATTENDANCE_COLUMNS].copy()
+
+
+def parse_orgs_file(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [o.strip() for o in f.read().splitlines() if o.strip()]
+
+
+def parse_org_passwords_file(path):
+    pw_df = pd.read_csv(path, dtype=str).fillna("")
+    if "Org" in pw_df.columns and "Password" in pw_df.columns:
+        return dict(zip(pw_df["Org"], pw_df["Password"]))
+    return {}
+
+
+def read_journal_events(path, offset=0):
+    # Only consume complete lines so a concurrent half-written event is picked up next time
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    # Header rows are skipped by their first cell, so journals written before a column was added still parse
+    rows = [r for r in csv.reader(data[:end].decode("utf-8").splitlines()) if r and r[0] != JOURNAL_COLUMNS[0]]
+    width = len(JOURNAL_COLUMNS)
+    events = pd.DataFrame([(r + [""] * width)[:width] for r in rows], columns=JOURNAL_COLUMNS, dtype=str).fillna("")
+    events["Email"] = normalize_email_series(events["Email"])
+    events["Phone"] = clean_phone_series(events["Phone"])
+    return events, offset + end
+
+
+def replay_attendance_events(rows, shifts, events, orgs=None, history=None, rollup=None):
+    # rows is the shared RowBuffer, so replay never concatenates the history;
+    # orgs (from build_org_partitions) and history (from build_history_index)
+    # get the label of every appended row, and rollup (rollups.index()) every punch
+    for event, row in zip(events["Event"], events[ATTENDANCE_COLUMNS].to_dict("records")):
+        key = row_shift_key(row)
+        if event == "in" and key not in shifts["rows"]:
+            label = rows.append(row)
+            add_to_shift_index(shifts, label, key, row["Time"], row["Clock Out Time"])
+            if orgs is not None:
+                orgs.setdefault(row["Org"], []).append(label)
+            if history is not None:
+                add_to_history_index(history, label, row)
+            if rollup is not None:
+                rollups.add_clock_in(rollup, key[1], key[0], key[2])
+        elif event == "out" and key in shifts["open"]:
+            clock_in_time = shifts["open"].pop(key)
+            rows.set_value(shifts["rows"][key], "Clock Out Time", row["Clock Out Time"])
+            if rollup is not None:
+                rollups.add_clock_out(rollup, key[1], key[0], key[2], clock_in_time, row["Clock Out Time"])
+
+
+def attendance_entry(frame, snapshot_sig):
+    # The cached state of a snapshot with no journal replayed yet. The indexes
+    # are built from the string frame; the rows are kept in compact types
+    return {"snapshot": snapshot_sig, "journal_inode": None, "offset": 0,
+            "rows": RowBuffer(ATTENDANCE_SCHEMA.compact(frame), schema=ATTENDANCE_SCHEMA),
+            "shifts": build_shift_index(frame),
+            "orgs": build_org_partitions(frame), "org_frames": {},
+            "history": build_history_index(frame), "rollups": rollups.index(*build_rollups(frame))}
+
+
+def relabel_attendance_entry(entry, mapping):
+    # Moves a cached attendance state to the new org names ({old: new}, all at once)
+    ATTENDANCE_SCHEMA.relabel(entry["rows"].frame(), "Org", mapping)
+    relabel_shift_index(entry["shifts"], mapping)
+    relabel_org_partitions(entry["orgs"], mapping)
+    relabel_history_index(entry["history"], mapping)
+    rollups.relabel(entry["rollups"], mapping)
+    for org in set(mapping) | set(mapping.values()):
+        entry["org_frames"].pop(org, None)
+
+
+class CsvRepository(Repository):
+    # Parsed files are cached on the instance (one per process) and keyed on each
+    # file's mtime/size/inode, so a rerun only re-parses a file that changed on disk.
+    # Cached attendance rows are held in ATTENDANCE_SCHEMA's compact types and
+    # expanded back to strings wherever they leave the repository.
+    # Clock-in/out append to the journal; loading replays snapshot + journal and
+    # compaction folds the journal back into the attendance snapshot.
+    # The file signatures double as version stamps.
+    # With attendance_format="parquet", attendance_file is the snapshot directory
+    # and its manifest stands in for the file.
+    def __init__(self, users_file, attendance_file, journal_file, org_file, org_password_file, lock_file,
+                 attendance_format="csv"):
+        self.users_file = users_file
+        self.attendance_file = attendance_file
+        self.attendance_format = attendance_format
+        self.journal_file = journal_file
+        self.org_file = org_file
+        self.org_password_file = org_password_file
+        self.lock = DataLock(lock_file)
+        self._cache_lock = threading.RLock()
+        self._entries = {}
+
+    def versions(self):
+        return {
+            USERS_TABLE: file_signature(self.users_file),
+            ATTENDANCE_TABLE: (self._snapshot_signature(), file_signature(self.journal_file)),
+            ORGS_TABLE: file_signature(self.org_file),
+            ORG_PASSWORDS_TABLE: file_signature(self.org_password_file),
+        }
+
+    def invalidate(self, *paths):
+        with self._cache_lock:
+            for path in (paths or list(self._entries)):
+                self._entries.pop(path, None)
+                self._entries.pop(("org_partitions", path), None)
+
+    def _cached_read(self, path, parser):
+        signature = file_signature(path)
+        if signature is None:
+            return None
+        with self._cache_lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != signature:
+                entry = (signature, parser(path))
+                self._entries[path] = entry
+        return entry[1]
+
+    def _snapshot_signature(self):
+        if self.attendance_format == "parquet":
+            return file_signature(attendance_parquet.manifest_path(self.attendance_file))
+        return file_signature(self.attendance_file)
+
+    def _read_snapshot(self):
+        if self.attendance_format == "parquet":
+            return attendance_parquet.read_snapshot(self.attendance_file)
+        return parse_attendance_file(self.attendance_file)
+
+    def _write_snapshot(self, frame):
+        if self.attendance_format == "parquet":
+            attendance_parquet.write_snapshot(frame, self.attendance_file, atomic_write)
+        else:
+            atomic_write_csv(frame, self.attendance_file)
+
+    def _load_attendance(self):
+        snapshot_sig = self._snapshot_signature()
+        journal_sig = file_signature(self.journal_file)
+        with self._cache_lock:
+            entry = self._entries.get(self.attendance_file)
+            # A new snapshot, or a journal that was replaced/truncated, means replaying from scratch
+            if (entry is None or entry["snapshot"] != snapshot_sig or
+                    (journal_sig is not None and entry["journal_inode"] not in (None, journal_sig[2])) or
+                    (journal_sig is None and entry["offset"] > 0) or
+                    (journal_sig is not None and journal_sig[1] < entry["offset"])):
+                frame = self._read_snapshot() if snapshot_sig is not None else pd.DataFrame(columns=ATTENDANCE_COLUMNS)
+                entry = attendance_entry(frame, snapshot_sig)
+                self._entries[self.attendance_file] = entry
+            if journal_sig is not None and journal_sig[1] > entry["offset"]:
+                events, offset = read_journal_events(self.journal_file, entry["offset"])
+                replay_attendance_events(entry["rows"], entry["shifts"], events, entry["orgs"], entry["history"],
+                                         entry["rollups"])
+                for org in events["Org"].unique():
+                    entry["org_frames"].pop(org, None)
+                entry["offset"] = offset
+                entry["journal_inode"] = journal_sig[2]
+            return entry["rows"], entry["shifts"]
+
+    def _attendance_frame(self):
+        with self._cache_lock:
+            return ATTENDANCE_SCHEMA.expand(self._load_attendance()[0].frame())
+
+    def _append_events(self, events):
+        # [(event, row)] in one append and one fsync
+        new_file = not os.path.exists(self.journal_file)
+        with open(self.journal_file, "a", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(JOURNAL_COLUMNS)
+            writer.writerows([event] + [row.get(c, "") or "" for c in ATTENDANCE_COLUMNS] for event, row in events)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compact_journal(self):
+        with self.lock:
+            if not os.path.exists(self.journal_file):
+                return
+            self._write_snapshot(self._attendance_frame())
+            os.remove(self.journal_file)
+            # The cached rows and indexes already hold every event just folded
+            # in, so they move over to the new snapshot instead of being rebuilt
+            with self._cache_lock:
+                entry = self._entries.get(self.attendance_file)
+                if entry is not None:
+                    entry.update(snapshot=self._snapshot_signature(), journal_inode=None, offset=0)
+
+    def _cache_snapshot(self, frame):
+        # Called once frame is written as the snapshot and the journal is gone: the
+        # cache is built straight from it instead of re-parsing the file on the next read
+        entry = attendance_entry(frame, self._snapshot_signature())
+        with self._cache_lock:
+            self._entries[self.attendance_file] = entry
+
+    def migrate_attendance(self, csv_file):
+        # One-shot conversion of an existing attendance CSV into this repository's snapshot
+        with self.lock:
+            self._write_snapshot(parse_attendance_file(csv_file))
+            self.invalidate(self.attendance_file)
+
+    def load_users(self):
+        cached = self._cached_read(self.users_file, parse_users_with_index)
+        if cached is None:
+            return pd.DataFrame(columns=USER_COLUMNS), new_user_index()
+        return cached
+
+    def attendance_snapshot(self):
+        rows, _ = self._load_attendance()
+        length = len(rows)
+
+        def load():
+            # The first `length` shared rows, i.e. the state at snapshot time
+            with self._cache_lock:
+                frame = rows.frame()
+            return ATTENDANCE_SCHEMA.expand(frame.iloc[:length])
+
+        return RowBuffer.lazy(load, length, ATTENDANCE_COLUMNS)
+
+    def load_organizations(self):
+        orgs = self._cached_read(self.org_file, parse_orgs_file)
+        return list(orgs) if orgs is not None else []
+
+    def load_org_passwords(self):
+        passwords = self._cached_read(self.org_password_file, parse_org_passwords_file)
+        return dict(passwords) if passwords is not None else {}
+
+    def save_users(self, users):
+        with self.lock:
+            atomic_write_csv(users, self.users_file)
+            self.invalidate(self.users_file)
+
+    def save_attendance(self, attendance):
+        # The frame already includes every replayed journal event
+        with self.lock:
+            attendance = parse_attendance_frame(attendance)
+            self._write_snapshot(attendance)
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+            self._cache_snapshot(attendance)
+
+    def save_organizations(self, organizations):
+        with self.lock:
+            atomic_write(self.org_file, lambda f: f.write("\n".join(organizations)))
+            self.invalidate(self.org_file)
+
+    def save_org_passwords(self, passwords):
+        with self.lock:
+            atomic_write_csv(org_passwords_frame(passwords), self.org_password_file)
+            self.invalidate(self.org_password_file)
+
+    def save_tables(self, tables):
+        with self.lock:
+            tables = dict(tables)
+            if ATTENDANCE_TABLE in tables:
+                tables[ATTENDANCE_TABLE] = parse_attendance_frame(tables[ATTENDANCE_TABLE])
+            self._write_tables(tables)
+            if ATTENDANCE_TABLE in tables:
+                self._cache_snapshot(tables[ATTENDANCE_TABLE])
+
+    def relabel_orgs(self, mapping):
+        # The cached attendance is relabeled in place: Org categories, index keys
+        # and rollups move to the new names, so nothing is re-parsed or rebuilt.
+        # The snapshot still stores Org names, so it is written from the cache,
+        # folding in the journal as compaction does, along with the users and org files
+        mapping = {old: new for old, new in mapping.items() if old != new}
+        if not mapping:
+            return
+        with self.lock:
+            users = self.load_users()[0].copy()
+            users["Org"] = users["Org"].replace(mapping)
+            tables = {
+                USERS_TABLE: users,
+                ORGS_TABLE: organizations_frame(relabel_organizations(self.load_organizations(), mapping)),
+                ORG_PASSWORDS_TABLE: org_passwords_frame(relabel_org_passwords(self.load_org_passwords(), mapping)),
+            }
+            with self._cache_lock:
+                self._load_attendance()
+                entry = self._entries[self.attendance_file]
+                relabel_attendance_entry(entry, mapping)
+                tables[ATTENDANCE_TABLE] = ATTENDANCE_SCHEMA.expand(entry["rows"].frame())
+            try:
+                self._write_tables(tables)
+            except BaseException:
+                self.invalidate(self.attendance_file)  # the cache no longer matches the files
+                raise
+            with self._cache_lock:
+                entry.update(snapshot=self._snapshot_signature(), journal_inode=None, offset=0)
+
+    def _write_tables(self, tables):
+        # The small files are staged first and only renamed in once the attendance
+        # snapshot (itself atomic) is written, so a failure leaves every file as it
+        # was; readers that skip the lock may briefly see a mix of old and new files.
+        # The attendance cache is left to the caller
+        writers = {
+            USERS_TABLE: (self.users_file, lambda frame: lambda f: frame.to_csv(f, index=False)),
+            ORGS_TABLE: (self.org_file, lambda frame: lambda f: f.write("\n".join(frame_organizations(frame)))),
+            ORG_PASSWORDS_TABLE: (self.org_password_file, lambda frame: lambda f: frame.to_csv(f, index=False)),
+        }
+        staged = []
+        try:
+            for table, (path, writer) in writers.items():
+                if table in tables:
+                    staged.append((stage_write(path, writer(tables[table])), path))
+            if ATTENDANCE_TABLE in tables:
+                self._write_snapshot(tables[ATTENDANCE_TABLE])
+        except BaseException:
+            for tmp_path, _ in staged:
+                os.remove(tmp_path)
+            raise
+        if ATTENDANCE_TABLE in tables and os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+        for tmp_path, path in staged:
+            os.replace(tmp_path, path)
+            self.invalidate(path)
+
+    def add_user(self, row):
+        self._append_users([row])
+
+    def _append_users(self, rows):
+        # Append lines in the file's own column order instead of rewriting users.csv
+        with self.lock:
+            columns = USER_COLUMNS
+            needs_newline = False
+            if os.path.exists(self.users_file) and os.path.getsize(self.users_file) > 0:
+                with open(self.users_file, "r", encoding="utf-8", newline="") as f:
+                    columns = next(csv.reader(f), None) or USER_COLUMNS
+                with open(self.users_file, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    needs_newline = f.read(1) != b"\n"
+                write_header = False
+            else:
+                write_header = True
+            with open(self.users_file, "a", encoding="utf-8", newline="") as f:
+                if needs_newline:
+                    f.write("\n")
+                writer = csv.writer(f, lineterminator="\n")
+                if write_header:
+                    writer.writerow(columns)
+                writer.writerows([row.get(c, "") for c in columns] for row in rows)
+                f.flush()
+                os.fsync(f.fileno())
+            self.invalidate(self.users_file)
+
+    def apply_writes(self, writes):
+        # Checked against the indexes plus the batch's own earlier writes, then
+        # one users.csv append and one journal append, each fsynced once
+        with self.lock:
+            _, shifts = self._load_attendance()
+            index = self.load_users()[1]
+            pending = {"email": set(), "phone": set()}
+            opened, closed = set(), set()
+            new_users, events, results = [], [], []
+            for op, args in writes:
+                if op == ADD_USER:
+                    added = claim_user_identifiers(index, pending, args[0])
+                    if added:
+                        new_users.append(args[0])
+                    results.append(added)
+                elif op == CLOCK_IN:
+                    row = args[0]
+                    key = row_shift_key({c: row.get(c, "") or "" for c in ATTENDANCE_COLUMNS})
+                    if key in shifts["rows"] or key in opened:
+                        results.append(False)
+                        continue
+                    opened.add(key)
+                    events.append(("in", row))
+                    results.append(True)
+                elif op == CLOCK_OUT:
+                    key, clock_out_time = args
+                    if key not in shifts["rows"] and key not in opened:
+                        results.append(NO_ACTIVE_CLOCK_IN)
+                    elif key in closed or (key not in shifts["open"] and key not in opened):
+                        results.append(ALREADY_CLOCKED_OUT)
+                    else:
+                        closed.add(key)
+                        events.append(("out", dict(zip(SHIFT_KEY_COLUMNS, key), **{"Clock Out Time": clock_out_time})))
+                        results.append(CLOCKED_OUT)
+                else:
+                    raise ValueError(f"Unknown write {op!r}")
+            # All or nothing: if either append fails, both files go back to their
+            # old length, so a retry never finds half of this batch already written
+            lengths = {path: os.path.getsize(path) if os.path.exists(path) else None
+                       for path in (self.users_file, self.journal_file)}
+            try:
+                if new_users:
+                    self._append_users(new_users)
+                if events:
+                    self._append_events(events)
+            except BaseException:
+                for path, length in lengths.items():
+                    truncate_file(path, length)
+                self.invalidate(self.users_file)
+                raise
+            journal_sig = file_signature(self.journal_file)
+            if journal_sig is not None and journal_sig[1] >= JOURNAL_COMPACT_BYTES:
+                try:
+                    self.compact_journal()
+                except Exception:
+                    pass  # the batch is already durable; compaction runs again after the next append
+            return results
+
+    def _rollups(self):
+        with self._cache_lock:
+            self._load_attendance()
+            return self._entries[self.attendance_file]["rollups"]
+
+    def org_daily_rollup(self, org, start_date=None, end_date=None):
+        with self._cache_lock:
+            return rollups.daily_frame(self._rollups(), org, start_date, end_date)
+
+    def org_monthly_rollup(self, org, month=None):
+        with self._cache_lock:
+            return rollups.monthly_frame(self._rollups(), org, month)
+
+    def rebuild_rollups(self):
+        # The rollups live in the attendance cache; rebuild them from its rows
+        with self._cache_lock:
+            daily, monthly = build_rollups(self._attendance_frame())
+            self._entries[self.attendance_file]["rollups"] = rollups.index(daily, monthly)
+            return daily, monthly
+
+    def _user_history(self, user_id, org):
+        # The person's rows, oldest first, gathered through the history index
+        with self._cache_lock:
+            rows, _ = self._load_attendance()
+            frame = rows.frame()
+            person = self._entries[self.attendance_file]["history"].get((user_id, org))
+            if person is None:
+                return ATTENDANCE_SCHEMA.expand(frame.iloc[:0])
+            history = ATTENDANCE_SCHEMA.expand(frame.take(person["labels"]))
+            if not person["sorted"]:
+                history = history.sort_values(["Clock In Date", "Time"], kind="stable")
+                person["labels"] = history.index.tolist()
+                person["last"] = tuple(history[["Clock In Date", "Time"]].iloc[-1])
+                person["sorted"] = True
+            return history
+
+    def user_attendance(self, user_id, org):
+        return self._user_history(user_id, org).iloc[::-1]
+
+    def user_attendance_page(self, user_id, org, month=None, offset=0, limit=31):
+        page, total, months = history_page(self._user_history(user_id, org), month, offset, limit)
+        return self.current_user_details(page), total, months
+
+    def _org_frame(self, org):
+        # An org's compact rows are gathered once and kept until a journal event
+        # for that org arrives
+        with self._cache_lock:
+            rows, _ = self._load_attendance()
+            entry = self._entries[self.attendance_file]
+            frame = entry["org_frames"].get(org)
+            if frame is None:
+                frame = rows.frame().take(entry["orgs"].get(org, []))
+                entry["org_frames"][org] = frame
+            return frame
+
+    def org_attendance(self, org):
+        return ATTENDANCE_SCHEMA.expand(self._org_frame(org))
+
+    def org_attendance_page(self, org, **filters):
+        # Dates, times and Org filter and sort in their compact types; only the
+        # page is expanded. User details need every row's current values first
+        if filters.get("name") or filters.get("sort_by") in USER_DETAIL_COLUMNS:
+            return super().org_attendance_page(org, **filters)
+        page, total = attendance_page(self._org_frame(org), **filters)
+        return self.current_user_details(ATTENDANCE_SCHEMA.expand(page)), total
+
+    def org_users(self, org):
+        # Partitions belong to the cached users frame, so they are only rebuilt
+        # after users.csv changes and is re-parsed
+        users = self.load_users()[0]
+        key = ("org_partitions", self.users_file)
+        with self._cache_lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] is not users:
+                entry = (users, build_org_partitions(users))
+                self._entries[key] = entry
+        return users.take(entry[1].get(org, []))
+
+
+# === SQLite backend ===
+USER_SQL_COLUMNS = ["email", "phone", "name", "gender", "age", "address", "org", "role", "user_id"]
+ATTENDANCE_SQL_COLUMNS = ["email", "phone", "name", "org", "clock_in_date", "time", "clock_out_time", "user_id"]
+
+SQLITE_TABLES = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL DEFAULT '',
+    phone TEXT NOT NULL DEFAULT '',
+    name TEXT NOT NULL DEFAULT '',
+    gender TEXT NOT NULL DEFAULT '',
+    age TEXT NOT NULL DEFAULT '',
+    address TEXT NOT NULL DEFAULT '',
+    org TEXT NOT NULL DEFAULT '',
+    role TEXT NOT NULL DEFAULT '',
+    user_id TEXT NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS attendance (
+    id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL DEFAULT '',
+    phone TEXT NOT NULL DEFAULT '',
+    name TEXT NOT NULL DEFAULT '',
+    org TEXT NOT NULL DEFAULT '',
+    clock_in_date TEXT NOT NULL DEFAULT '',
+    time TEXT NOT NULL DEFAULT '',
+    clock_out_time TEXT NOT NULL DEFAULT '',
+    user_id TEXT NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS organizations (
+    position INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS org_passwords (
+    org TEXT PRIMARY KEY,
+    password TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+-- Rollups (see rollups.py), written in the same transaction as the attendance rows
+CREATE TABLE IF NOT EXISTS attendance_daily (
+    org TEXT NOT NULL,
+    day TEXT NOT NULL,
+    present INTEGER NOT NULL DEFAULT 0,
+    minutes REAL NOT NULL DEFAULT 0,
+    open_shifts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (org, day)
+);
+
+CREATE TABLE IF NOT EXISTS attendance_monthly (
+    org TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    month TEXT NOT NULL,
+    present INTEGER NOT NULL DEFAULT 0,
+    minutes REAL NOT NULL DEFAULT 0,
+    open_shifts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (org, user_id, month)
+);
+"""
+
+# Created after SQLITE_TABLES and the user_id migration, which older databases need first
+SQLITE_INDEXES = """
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE INDEX IF NOT EXISTS users_phone ON users (phone);
+CREATE INDEX IF NOT EXISTS users_org ON users (org);
+CREATE INDEX IF NOT EXISTS users_user_id ON users (user_id);
+
+-- Attendance is read by user_id and by org only; older databases also had
+-- indexes on phone and on the date alone, which just slowed every insert
+DROP INDEX IF EXISTS attendance_shift;
+DROP INDEX IF EXISTS attendance_phone;
+DROP INDEX IF EXISTS attendance_date;
+CREATE INDEX IF NOT EXISTS attendance_user_shift ON attendance (user_id, org, clock_in_date);
+CREATE INDEX IF NOT EXISTS attendance_org_date ON attendance (org, clock_in_date);
+"""
+
+
+ADD_TO_DAILY_ROLLUP = (
+    "INSERT INTO attendance_daily (org, day, present, minutes, open_shifts) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT(org, day) DO UPDATE SET present = present + excluded.present, "
+    "minutes = round(minutes + excluded.minutes, 2), open_shifts = open_shifts + excluded.open_shifts"
+)
+ADD_TO_MONTHLY_ROLLUP = (
+    "INSERT INTO attendance_monthly (org, user_id, month, present, minutes, open_shifts) VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(org, user_id, month) DO UPDATE SET present = present + excluded.present, "
+    "minutes = round(minutes + excluded.minutes, 2), open_shifts = open_shifts + excluded.open_shifts"
+)
+
+
+class SqliteRepository(Repository):
+    # One connection per thread; WAL lets readers run alongside the single writer.
+    # meta.<table>_version is bumped by every write to that table; it is the stamp
+    # versions() reports, and the shared users frame and its index are only rebuilt
+    # when users_version moved.
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.lock = DataLock(path + ".lock")
+        self._cache_lock = threading.Lock()
+        self._users = None
+        conn = self._connect()
+        conn.executescript(SQLITE_TABLES)
+        for table in ("users", "attendance"):
+            columns = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+            if "user_id" not in columns:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN user_id TEXT NOT NULL DEFAULT ''")
+        conn.executescript(SQLITE_INDEXES)
+        # Databases from before the rollup tables get them filled once
+        if conn.execute("SELECT NOT EXISTS (SELECT 1 FROM attendance_daily) "
+                        "AND EXISTS (SELECT 1 FROM attendance)").fetchone()[0]:
+            self.rebuild_rollups()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _query(self, sql, params, columns):
+        rows = self._connect().execute(sql, params).fetchall()
+        return pd.DataFrame(rows, columns=columns)
+
+    def _version(self, conn, table):
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (f"{table}_version",)).fetchone()
+        return row[0] if row else 0
+
+    def _bump_version(self, conn, table):
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, 1) "
+            "ON CONFLICT(key) DO UPDATE SET value = value + 1",
+            (f"{table}_version",),
+        )
+
+    def versions(self):
+        conn = self._connect()
+        return {table: self._version(conn, table) for table in TABLES}
+
+    def is_empty(self):
+        conn = self._connect()
+        return all(
+            conn.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {table})").fetchone()[0]
+            for table in ("users", "attendance", "organizations", "org_passwords")
+        )
+
+    def import_from(self, repository):
+        # One-shot migration, e.g. from the CSV files into a new database
+        self.save_users(repository.load_users()[0])
+        self.save_attendance(repository.attendance_snapshot().frame())
+        self.save_organizations(repository.load_organizations())
+        self.save_org_passwords(repository.load_org_passwords())
+
+    def load_users(self):
+        version = self._version(self._connect(), USERS_TABLE)
+        with self._cache_lock:
+            if self._users is None or self._users[0] != version:
+                users = self._query(f"SELECT {', '.join(USER_SQL_COLUMNS)} FROM users ORDER BY id", (), USER_COLUMNS)
+                self._users = (version, users, build_user_index(users))
+            return self._users[1], self._users[2]
+
+    def attendance_snapshot(self):
+        length = self._connect().execute("SELECT COUNT(*) FROM attendance").fetchone()[0]
+
+        def load():
+            return self._query(
+                f"SELECT {', '.join(ATTENDANCE_SQL_COLUMNS)} FROM attendance ORDER BY id LIMIT ?",
+                (length,), ATTENDANCE_COLUMNS,
+            )
+
+        return RowBuffer.lazy(load, length, ATTENDANCE_COLUMNS)
+
+    def load_organizations(self):
+        return [r[0] for r in self._connect().execute("SELECT name FROM organizations ORDER BY position")]
+
+    def load_org_passwords(self):
+        return dict(self._connect().execute("SELECT org, password FROM org_passwords"))
+
+    def _replace_rows(self, conn, table, sql_columns, frame, columns):
+        conn.execute(f"DELETE FROM {table}")
+        placeholders = ", ".join("?" for _ in sql_columns)
+        conn.executemany(
+            f"INSERT INTO {table} ({', '.join(sql_columns)}) VALUES ({placeholders})",
+            frame.reindex(columns=columns).fillna("").astype(str).itertuples(index=False, name=None),
+        )
+
+    def _replace_attendance(self, conn, attendance):
+        attendance = attendance.reindex(columns=ATTENDANCE_COLUMNS).fillna("").astype(str)
+        self._replace_rows(conn, "attendance", ATTENDANCE_SQL_COLUMNS, attendance, ATTENDANCE_COLUMNS)
+        self._write_rollups(conn, *build_rollups(attendance))
+
+    def _write_rollups(self, conn, daily, monthly):
+        conn.execute("DELETE FROM attendance_daily")
+        conn.execute("DELETE FROM attendance_monthly")
+        conn.executemany(
+            "INSERT INTO attendance_daily (org, day, present, minutes, open_shifts) VALUES (?, ?, ?, ?, ?)",
+            daily[["Org", "Date"] + rollups.MEASURES].itertuples(index=False, name=None),
+        )
+        conn.executemany(
+            "INSERT INTO attendance_monthly (org, user_id, month, present, minutes, open_shifts) VALUES (?, ?, ?, ?, ?, ?)",
+            monthly[["Org", "User ID", "Month"] + rollups.MEASURES].itertuples(index=False, name=None),
+        )
+
+    def _add_to_rollups(self, conn, org, identity, date, present=0, minutes=0.0, open_shifts=0):
+        # The incremental form of _write_rollups for one punch
+        conn.execute(ADD_TO_DAILY_ROLLUP, (org, date, present, minutes, open_shifts))
+        conn.execute(ADD_TO_MONTHLY_ROLLUP, (org, identity, date[:7], present, minutes, open_shifts))
+
+    def rebuild_rollups(self):
+        with self.lock, self._transaction() as conn:
+            attendance = self._query(f"SELECT {', '.join(ATTENDANCE_SQL_COLUMNS)} FROM attendance ORDER BY id", (),
+                                     ATTENDANCE_COLUMNS)
+            daily, monthly = build_rollups(attendance)
+            self._write_rollups(conn, daily, monthly)
+            return daily, monthly
+
+    def org_daily_rollup(self, org, start_date=None, end_date=None):
+        where = "org = ?"
+        params = [org]
+        if start_date:
+            where += " AND day >= ?"
+            params.append(start_date)
+        if end_date:
+            where += " AND day <= ?"
+            params.append(end_date)
+        return self._query(
+            f"SELECT day, present, minutes, open_shifts FROM attendance_daily WHERE {where} ORDER BY day",
+            params, rollups.DAILY_COLUMNS,
+        )
+
+    def org_monthly_rollup(self, org, month=None):
+        where = "org = ?"
+        params = [org]
+        if month:
+            where += " AND month = ?"
+            params.append(month)
+        return self._query(
+            f"SELECT user_id, month, present, minutes, open_shifts FROM attendance_monthly WHERE {where} "
+            "ORDER BY month, user_id",
+            params, rollups.MONTHLY_COLUMNS,
+        )
+
+    # Every write also holds the DataLock, so single-row writes cannot slip in
+    # between a session's version check and its whole-table save
+    def save_users(self, users):
+        with self.lock, self._transaction() as conn:
+            self._replace_rows(conn, "users", USER_SQL_COLUMNS, users, USER_COLUMNS)
+            self._bump_version(conn, USERS_TABLE)
+
+    def save_attendance(self, attendance):
+        with self.lock, self._transaction() as conn:
+            self._replace_attendance(conn, attendance)
+            self._bump_version(conn, ATTENDANCE_TABLE)
+
+    def save_organizations(self, organizations):
+        with self.lock, self._transaction() as conn:
+            conn.execute("DELETE FROM organizations")
+            conn.executemany("INSERT INTO organizations (position, name) VALUES (?, ?)", enumerate(organizations))
+            self._bump_version(conn, ORGS_TABLE)
+
+    def save_org_passwords(self, passwords):
+        with self.lock, self._transaction() as conn:
+            conn.execute("DELETE FROM org_passwords")
+            conn.executemany("INSERT INTO org_passwords (org, password) VALUES (?, ?)", passwords.items())
+            self._bump_version(conn, ORG_PASSWORDS_TABLE)
+
+    def save_tables(self, tables):
+        # One transaction: other connections see every table change at once
+        with self.lock, self._transaction() as conn:
+            if USERS_TABLE in tables:
+                self._replace_rows(conn, "users", USER_SQL_COLUMNS, tables[USERS_TABLE], USER_COLUMNS)
+            if ATTENDANCE_TABLE in tables:
+                self._replace_attendance(conn, tables[ATTENDANCE_TABLE])
+            if ORGS_TABLE in tables:
+                conn.execute("DELETE FROM organizations")
+                conn.executemany("INSERT INTO organizations (position, name) VALUES (?, ?)",
+                                 enumerate(frame_organizations(tables[ORGS_TABLE])))
+            if ORG_PASSWORDS_TABLE in tables:
+                conn.execute("DELETE FROM org_passwords")
+                conn.executemany("INSERT INTO org_passwords (org, password) VALUES (?, ?)",
+                                 frame_org_passwords(tables[ORG_PASSWORDS_TABLE]).items())
+            for table in tables:
+                self._bump_version(conn, table)
+
+    def relabel_orgs(self, mapping):
+        # UPDATEs in place of a full save_tables(): rows and rollups of other orgs
+        # are untouched, and a merged org's rollup rows are added into the target's
+        mapping = {old: new for old, new in mapping.items() if old != new}
+        if not mapping:
+            return
+        case = "CASE org " + " ".join("WHEN ? THEN ?" for _ in mapping) + " ELSE org END"
+        case_params = [value for pair in mapping.items() for value in pair]
+        where = f"org IN ({', '.join('?' for _ in mapping)})"
+        sources = list(mapping)
+        with self.lock, self._transaction() as conn:
+            for table in ("users", "attendance"):
+                conn.execute(f"UPDATE {table} SET org = {case} WHERE {where}", case_params + sources)
+            for table, keys, upsert in (("attendance_daily", "day", ADD_TO_DAILY_ROLLUP),
+                                        ("attendance_monthly", "user_id, month", ADD_TO_MONTHLY_ROLLUP)):
+                moved = conn.execute(f"SELECT {case}, {keys}, present, minutes, open_shifts FROM {table} WHERE {where}",
+                                     case_params + sources).fetchall()
+                conn.execute(f"DELETE FROM {table} WHERE {where}", sources)
+                conn.executemany(upsert, moved)
+            organizations = [r[0] for r in conn.execute("SELECT name FROM organizations ORDER BY position")]
+            conn.execute("DELETE FROM organizations")
+            conn.executemany("INSERT INTO organizations (position, name) VALUES (?, ?)",
+                             enumerate(relabel_organizations(organizations, mapping)))
+            passwords = dict(conn.execute("SELECT org, password FROM org_passwords"))
+            conn.execute("DELETE FROM org_passwords")
+            conn.executemany("INSERT INTO org_passwords (org, password) VALUES (?, ?)",
+                             relabel_org_passwords(passwords, mapping).items())
+            for table in TABLES:
+                self._bump_version(conn, table)
+
+    def _insert_user(self, conn, row):
+        conn.execute(
+            f"INSERT INTO users ({', '.join(USER_SQL_COLUMNS)}) VALUES ({', '.join('?' for _ in USER_SQL_COLUMNS)})",
+            [str(row.get(c, "") or "") for c in USER_COLUMNS],
+        )
+
+    def add_user(self, row):
+        with self.lock, self._transaction() as conn:
+            self._insert_user(conn, row)
+            self._bump_version(conn, USERS_TABLE)
+
+    def _clock_in(self, conn, row):
+        key = [row.get(c, "") or "" for c in SHIFT_KEY_COLUMNS]
+        exists = conn.execute(
+            "SELECT 1 FROM attendance WHERE user_id = ? AND org = ? AND clock_in_date = ? LIMIT 1", key
+        ).fetchone()
+        if exists:
+            return False
+        values = {c: row.get(c, "") or "" for c in ATTENDANCE_COLUMNS}
+        conn.execute(
+            f"INSERT INTO attendance ({', '.join(ATTENDANCE_SQL_COLUMNS)}) VALUES ({', '.join('?' for _ in ATTENDANCE_SQL_COLUMNS)})",
+            list(values.values()),
+        )
+        identity, org, date = row_shift_key(values)
+        self._add_to_rollups(conn, org, identity, date, present=1, open_shifts=1)
+        return True
+
+    def _clock_out(self, conn, key, clock_out_time):
+        shift = "user_id = ? AND org = ? AND clock_in_date = ?"
+        punches = conn.execute(f"SELECT time, clock_out_time FROM attendance WHERE {shift}", key).fetchall()
+        if not punches:
+            return NO_ACTIVE_CLOCK_IN
+        if any(out for _, out in punches):
+            return ALREADY_CLOCKED_OUT
+        conn.execute(f"UPDATE attendance SET clock_out_time = ? WHERE {shift}", [clock_out_time, *key])
+        minutes = sum(rollups.punch_minutes(clock_in_time, clock_out_time) for clock_in_time, _ in punches)
+        identity, org, date = key
+        self._add_to_rollups(conn, org, identity, date, minutes=minutes, open_shifts=-len(punches))
+        return CLOCKED_OUT
+
+    def apply_writes(self, writes):
+        # One transaction for the whole batch, committed with synchronous=FULL so
+        # the acknowledgement is fsynced (other writes keep WAL's NORMAL)
+        conn = self._connect()
+        conn.execute("PRAGMA synchronous=FULL")
+        try:
+            with self.lock, self._transaction() as conn:
+                index = self.load_users()[1]
+                pending = {"email": set(), "phone": set()}
+                results = []
+                for op, args in writes:
+                    if op == ADD_USER:
+                        added = claim_user_identifiers(index, pending, args[0])
+                        if added:
+                            self._insert_user(conn, args[0])
+                        results.append(added)
+                    elif op == CLOCK_IN:
+                        results.append(self._clock_in(conn, *args))
+                    elif op == CLOCK_OUT:
+                        results.append(self._clock_out(conn, *args))
+                    else:
+                        raise ValueError(f"Unknown write {op!r}")
+                if any(op == ADD_USER and added for (op, _), added in zip(writes, results)):
+                    self._bump_version(conn, USERS_TABLE)
+                if any(result in (True, CLOCKED_OUT) for (op, _), result in zip(writes, results) if op != ADD_USER):
+                    self._bump_version(conn, ATTENDANCE_TABLE)
+                return results
+        finally:
+            conn.execute("PRAGMA synchronous=NORMAL")
+
+    def user_attendance(self, user_id, org):
+        return self._query(
+            f"SELECT {', '.join(ATTENDANCE_SQL_COLUMNS)} FROM attendance "
+            "WHERE user_id = ? AND org = ? ORDER BY clock_in_date DESC, time DESC",
+            (user_id, org), ATTENDANCE_COLUMNS,
+        )
+
+    def org_attendance(self, org):
+        return self._query(
+            f"SELECT {', '.join(ATTENDANCE_SQL_COLUMNS)} FROM attendance WHERE org = ? ORDER BY id",
+            (org,), ATTENDANCE_COLUMNS,
+        )
+
+    def user_attendance_page(self, user_id, org, month=None, offset=0, limit=31):
+        # Served from the (user_id, org, clock_in_date) index: months and the
+        # count come from the index, and only one page of rows is read
+        conn = self._connect()
+        identity = "user_id = ? AND org = ?"
+        params = [user_id, org]
+        months = [r[0] for r in conn.execute(
+            f"SELECT DISTINCT substr(clock_in_date, 1, 7) AS month FROM attendance WHERE {identity} "
+            "AND clock_in_date != '' ORDER BY month DESC", params)]
+        if month:
+            identity += " AND clock_in_date >= ? AND clock_in_date < ?"
+            params += [month, month + "~"]  # "~" sorts after every "-DD" suffix
+        total = conn.execute(f"SELECT COUNT(*) FROM attendance WHERE {identity}", params).fetchone()[0]
+        page = self._query(
+            f"SELECT {', '.join(ATTENDANCE_SQL_COLUMNS)} FROM attendance WHERE {identity} "
+            "ORDER BY clock_in_date DESC, time DESC, id DESC LIMIT ? OFFSET ?",
+            params + [limit, offset], ATTENDANCE_COLUMNS,
+        )
+        return self.current_user_details(page), total, months
+
+    def org_attendance_page(self, org, start_date=None, end_date=None, name="", open_only=False,
+                            sort_by="Clock In Date", descending=True, offset=0, limit=50):
+        # Filters, count and LIMIT/OFFSET run in SQLite on the (org, clock_in_date)
+        # index; only the requested page is read back. Email/Phone/Name are the
+        # user's current ones, joined by user_id, falling back to the punch-time values
+        sql_column = {c: f"a.{s}" for c, s in zip(ATTENDANCE_COLUMNS, ATTENDANCE_SQL_COLUMNS)}
+        sql_column.update({c: f"COALESCE(u.{s}, a.{s})" for c, s in zip(ATTENDANCE_COLUMNS, ATTENDANCE_SQL_COLUMNS)
+                           if c in USER_DETAIL_COLUMNS})
+        tables = "attendance a LEFT JOIN users u ON a.user_id != '' AND u.user_id = a.user_id"
+        where = ["a.org = ?"]
+        params = [org]
+        if start_date:
+            where.append("a.clock_in_date >= ?")
+            params.append(start_date)
+        if end_date:
+            where.append("a.clock_in_date <= ?")
+            params.append(end_date)
+        if name:
+            where.append(f"{sql_column['Name']} LIKE ? ESCAPE '\\'")
+            params.append("%" + name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        if open_only:
+            where.append("a.clock_out_time = ''")
+        where = " AND ".join(where)
+        direction = "DESC" if descending else "ASC"
+        order = ", ".join(f"{sql_column[c]} {direction}" for c in attendance_sort_keys(sort_by))
+        total = self._connect().execute(f"SELECT COUNT(*) FROM {tables} WHERE {where}", params).fetchone()[0]
+        page = self._query(
+            f"SELECT {', '.join(sql_column[c] for c in ATTENDANCE_COLUMNS)} FROM {tables} WHERE {where} "
+            f"ORDER BY {order}, a.id LIMIT ? OFFSET ?",
+            params + [limit, offset], ATTENDANCE_COLUMNS,
+        )
+        return page, total
+
+    def org_users(self, org):
+        return self._query(
+            f"SELECT {', '.join(USER_SQL_COLUMNS)} FROM users WHERE org = ? ORDER BY id",
+            (org,), USER_COLUMNS,
+        )
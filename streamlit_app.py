@@ -1,18 +1,45 @@
 import streamlit as st
 import pandas as pd
+from contextlib import contextmanager
 from datetime import datetime
 import os
+import threading
 import pytz
-import re
-import shutil
+
+import attendance_parquet
+import timesheet
+from backups import BackupStore
+from exports import FORMAT_LABELS, available_formats, export_bytes, in_date_range
+from group_commit import GroupCommitQueue
+from normalization import clean_phone, clean_phone_series, normalize_email, normalize_email_series, normalize_identifier
+from roster_import import DIFF_COLUMNS, MissingColumnsError, diff_roster, existing_identifiers, import_roster
+from row_buffer import RowBuffer
+from schema import ATTENDANCE_SCHEMA, USERS_SCHEMA
+from storage import (
+    ADD_USER, ALREADY_CLOCKED_OUT, ATTENDANCE_COLUMNS, ATTENDANCE_SORT_COLUMNS, CLOCK_IN, CLOCK_OUT, NO_ACTIVE_CLOCK_IN,
+    USER_COLUMNS,
+    ATTENDANCE_TABLE, ORG_PASSWORDS_TABLE, ORGS_TABLE, USERS_TABLE,
+    CsvRepository, LockTimeout, SqliteRepository,
+    add_to_user_index, assign_user_ids, build_user_index, new_user_id, new_user_index, org_passwords_frame, organizations_frame,
+    remove_from_user_index, shift_key,
+)
 
 # === Files ===
 USERS_FILE = "users.csv"
 ATTENDANCE_FILE = "attendance.csv"
+ATTENDANCE_JOURNAL_FILE = "attendance_journal.csv"  # append-only clock-in/out events
 ORG_FILE = "orgs.csv"
 ORG_PASSWORD_FILE = "org_passwords.csv"  # per-org admin passwords
+DATA_LOCK_FILE = "data.lock"  # advisory lock shared by every writer process
 DEFAULT_ADMIN_PASSWORD = "admin123"  # Default password for new orgs
 BACKUP_DIR = "backups"
+SQLITE_FILE = "attendance.db"
+STORAGE_BACKEND = os.environ.get("ATTENDANCE_STORAGE", "csv")  # "csv" or "sqlite"
+ATTENDANCE_PARQUET_DIR = "attendance_parquet"
+ATTENDANCE_SNAPSHOT = os.environ.get("ATTENDANCE_SNAPSHOT", "csv")  # "csv" or "parquet" (needs pyarrow)
+ATTENDANCE_PAGE_SIZES = [25, 50, 100, 250]  # admin attendance grid
+HISTORY_PAGE_SIZE = 31  # a user's own records per page
+WRITE_ACK_TIMEOUT = 40  # seconds to wait for a queued write to be committed
 
 # === Translation dictionary (English / 中文) ===
 t = {
@@ -114,6 +141,7 @@ t = {
         "missing_user_info": "User information missing. Please login or register.",
         "user_identifier_missing": "User identifier missing. Please contact your admin.",
         "save_error": "Error saving data: {error}",
+        "save_busy": "The data is busy being saved by someone else. Please try again.",
         "load_users_error": "Error loading users file: {error}",
         "load_attendance_error": "Error loading attendance file: {error}",
         "load_orgs_error": "Error loading organizations file: {error}",
@@ -233,6 +261,7 @@ t = {
         "missing_user_info": "用户信息缺失。请登录或注册。",
         "user_identifier_missing": "用户标识缺失。请联系您的管理员。",
         "save_error": "保存数据出错：{error}",
+        "save_busy": "数据正在被其他人保存，请稍后再试。",
         "load_users_error": "加载用户文件出错：{error}",
         "load_attendance_error": "加载考勤文件出错：{error}",
         "load_orgs_error": "加载组织文件出错：{error}",
@@ -265,142 +294,203 @@ def tr(key, **kwargs):
     except Exception:
         return text
 
-# === Helpers: phone/email normalization ===
-def clean_phone(raw):
-    if pd.isna(raw) or raw is None:
-        return ""
-    s = str(raw).strip()
-    if s == "":
-        return ""
-    s = re.sub(r'\.0+$', '', s)
-    digits = re.sub(r'\D', '', s)
-    if digits == "":
-        return ""
-    if digits.startswith("60") and len(digits) > 2:
-        digits = "0" + digits[2:]
-    if not digits.startswith("0") and len(digits) == 9:
-        digits = "0" + digits
-    return digits
-
-def clean_contact_field(raw):
-    if pd.isna(raw) or raw is None:
-        return ""
-    s = str(raw).strip()
-    if s == "":
-        return ""
-    if "@" in s:
-        return s.lower()
-    return clean_phone(s)
-
-def normalize_identifier(identifier):
-    if pd.isna(identifier) or identifier is None:
-        return ""
-    s = str(identifier).strip()
-    if s == "":
-        return ""
-    if "@" in s:
-        return s.lower()
-    return clean_phone(s)
-
 # === Persistence & backup helpers ===
-def ensure_backup_dir():
-    if not os.path.exists(BACKUP_DIR):
-        os.makedirs(BACKUP_DIR)
-
-def backup_users():
-    ensure_backup_dir()
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_file = os.path.join(BACKUP_DIR, f"users_backup_{timestamp}.csv")
-    if os.path.exists(USERS_FILE):
-        shutil.copy(USERS_FILE, backup_file)
-    else:
-        # if no users.csv yet, still create empty backup for traceability
-        pd.DataFrame(columns=st.session_state.get("users", pd.DataFrame()).columns).to_csv(backup_file, index=False)
-    return backup_file
+@st.cache_resource
+def get_backup_store():
+    # One store (and cached manifest) per process; old full-copy backups are folded in once
+    store = BackupStore(BACKUP_DIR)
+    store.import_legacy()
+    return store
+
+def backup_all(note="", tables=None):
+    # All four tables as stored, as one set; call inside locked_write() so no
+    # other writer lands between the tables. Empty tables still produce a
+    # (header-only) snapshot for traceability.
+    store = get_backup_store()
+    set_id = store.snapshot_set(tables if tables is not None else get_repository().export_tables(), note=note)
+    store.prune()
+    return set_id
 
 def list_backups():
-    ensure_backup_dir()
-    return sorted([f for f in os.listdir(BACKUP_DIR) if f.startswith("users_backup")], reverse=True)
+    return get_backup_store().sets()
+
+@st.cache_data(max_entries=4)
+def backup_zip_bytes(set_id):
+    # Snapshot sets never change, so the id alone is the cache key
+    return get_backup_store().zip_bytes(set_id)
+
+# === Storage ===
+# One repository per process, shared by every session; see storage.py
+def csv_repository():
+    if ATTENDANCE_SNAPSHOT == "parquet":
+        repo = CsvRepository(USERS_FILE, ATTENDANCE_PARQUET_DIR, ATTENDANCE_JOURNAL_FILE, ORG_FILE, ORG_PASSWORD_FILE,
+                             DATA_LOCK_FILE, attendance_format="parquet")
+        # First run on Parquet: convert the existing attendance.csv once
+        if not os.path.exists(attendance_parquet.manifest_path(ATTENDANCE_PARQUET_DIR)) and os.path.exists(ATTENDANCE_FILE):
+            repo.migrate_attendance(ATTENDANCE_FILE)
+        return repo
+    return CsvRepository(USERS_FILE, ATTENDANCE_FILE, ATTENDANCE_JOURNAL_FILE, ORG_FILE, ORG_PASSWORD_FILE, DATA_LOCK_FILE)
+
+@st.cache_resource
+def get_repository():
+    if STORAGE_BACKEND == "sqlite":
+        repo = SqliteRepository(SQLITE_FILE)
+        if repo.is_empty() and any(os.path.exists(f) for f in (USERS_FILE, ATTENDANCE_FILE, ORG_FILE)):
+            repo.import_from(csv_repository())
+    else:
+        repo = csv_repository()
+    # Data from before User IDs: give every user one and link their attendance rows
+    repo.migrate_user_ids()
+    return repo
+
+@st.cache_resource
+def get_write_queue():
+    # One group-commit writer per process; it flushes itself at exit
+    return GroupCommitQueue(get_repository())
+
+def commit_write(op, *args):
+    # Registrations and punches share the writer's next group commit. Returns
+    # the write's result once it is on disk, or None after showing why not.
+    # Never call this inside locked_write(): the writer needs that lock, so
+    # waiting for it here would only time out.
+    if get_repository().write_lock().held_by_current_thread():
+        raise RuntimeError("commit_write() called while holding the data lock")
+    try:
+        return get_write_queue().submit(op, *args).wait(WRITE_ACK_TIMEOUT)
+    except LockTimeout:
+        st.error(tr("save_busy"))
+    except TimeoutError:
+        st.warning("Still saving, please check again in a moment.")
+    except Exception as e:
+        st.error(tr("save_error", error=str(e)))
+    return None
+
+# === Shared data ===
+# One compact users frame (and its index) per users version for the whole process.
+# Sessions read it in place and only copy it when they write (see RowBuffer.copy_on_write);
+# writes are coordinated by locked_write(), so resident memory is O(data), not O(data x sessions).
+@st.cache_resource
+def shared_data():
+    return {"lock": threading.Lock(), USERS_TABLE: None}
+
+def shared_users(repo, version):
+    shared = shared_data()
+    with shared["lock"]:
+        entry = shared[USERS_TABLE]
+        if entry is None or entry[0] != version:
+            users, index = repo.load_users()
+            entry = (version, USERS_SCHEMA.compact(users), index)
+            shared[USERS_TABLE] = entry
+        return entry[1], entry[2]
+
+def writable_user_index():
+    # The index is shared with every session until this one changes it
+    if st.session_state.user_index_shared:
+        st.session_state.user_index = {field: dict(ids) for field, ids in st.session_state.user_index.items()}
+        st.session_state.user_index_shared = False
+    return st.session_state.user_index
+
+# === Dirty tracking ===
+def mark_dirty(*tables):
+    st.session_state.dirty_tables.update(tables)
+
+@contextmanager
+def locked_write():
+    # Read-modify-write for session-side edits: hold the data lock for the whole
+    # change, and if any table moved on since this run loaded it, reload first so
+    # the change lands on the latest data instead of overwriting another writer's
+    repo = get_repository()
+    lock = repo.write_lock()
+    try:
+        lock.acquire()
+    except LockTimeout:
+        st.error(tr("save_busy"))
+        st.stop()
+    try:
+        if repo.versions() != st.session_state.versions:
+            load_data()
+        yield
+        save_data()
+        st.session_state.versions = repo.versions()
+    finally:
+        lock.release()
 
 # === Load and Save ===
 def load_data():
+    # Sessions read the process-wide data and take their own copy of a table only
+    # when they write to it, so in-place edits never leak into the shared data.
+    # Frames use the compact column types of schema.py.
+    # Anything not saved by the previous run is discarded along with its dirty flags
+    st.session_state.dirty_tables = set()
+    repo = get_repository()
+    # Taken before reading, so a write that lands mid-load still shows up as stale
+    st.session_state.versions = repo.versions()
     try:
-        if os.path.exists(USERS_FILE):
-            users = pd.read_csv(USERS_FILE, dtype=str).fillna("")
-            # ensure columns exist
-            for c in ["Email", "Phone", "Name", "Gender", "Age", "Address", "Org", "Role"]:
-                if c not in users.columns:
-                    users[c] = ""
-            users["Email"] = users["Email"].apply(lambda x: str(x).strip().lower() if x else "")
-            users["Phone"] = users["Phone"].apply(lambda x: clean_phone(x))
-            st.session_state.users = users[["Email", "Phone", "Name", "Gender", "Age", "Address", "Org", "Role"]].copy()
-        else:
-            st.session_state.users = pd.DataFrame(columns=["Email", "Phone", "Name", "Gender", "Age", "Address", "Org", "Role"])
+        users, index = shared_users(repo, st.session_state.versions[USERS_TABLE])
+        st.session_state.users = RowBuffer.copy_on_write(users, USER_COLUMNS, schema=USERS_SCHEMA)
+        st.session_state.user_index = index
+        st.session_state.user_index_shared = True
     except Exception as e:
         st.error(tr("load_users_error", error=str(e)))
-        st.session_state.users = pd.DataFrame(columns=["Email", "Phone", "Name", "Gender", "Age", "Address", "Org", "Role"])
+        st.session_state.users = RowBuffer(columns=USER_COLUMNS, schema=USERS_SCHEMA)
+        st.session_state.user_index = new_user_index()
+        st.session_state.user_index_shared = False
 
     try:
-        if os.path.exists(ATTENDANCE_FILE):
-            att = pd.read_csv(ATTENDANCE_FILE, dtype=str).fillna("")
-            required_columns = ["Email", "Phone", "Name", "Org", "Clock In Date", "Time", "Clock Out Time"]
-            for col in required_columns:
-                if col not in att.columns:
-                    att[col] = ""
-            att["Email"] = att["Email"].apply(lambda x: str(x).strip().lower())
-            att["Phone"] = att["Phone"].apply(clean_phone)
-            st.session_state.attendance = att[required_columns].copy()
-        else:
-            st.session_state.attendance = pd.DataFrame(columns=["Email", "Phone", "Name", "Org", "Clock In Date", "Time", "Clock Out Time"])
+        snapshot = repo.attendance_snapshot()
+        st.session_state.attendance = RowBuffer.lazy(
+            lambda: ATTENDANCE_SCHEMA.compact(snapshot.frame()), len(snapshot), ATTENDANCE_COLUMNS, schema=ATTENDANCE_SCHEMA
+        )
     except Exception as e:
         st.error(tr("load_attendance_error", error=str(e)))
-        st.session_state.attendance = pd.DataFrame(columns=["Email", "Phone", "Name", "Org", "Clock In Date", "Time", "Clock Out Time"])
+        st.session_state.attendance = RowBuffer(columns=ATTENDANCE_COLUMNS, schema=ATTENDANCE_SCHEMA)
 
     try:
-        if os.path.exists(ORG_FILE):
-            with open(ORG_FILE, 'r', encoding='utf-8') as f:
-                st.session_state.organizations = [o.strip() for o in f.read().splitlines() if o.strip()]
-        else:
-            st.session_state.organizations = []
+        st.session_state.organizations = repo.load_organizations()
     except Exception as e:
         st.error(tr("load_orgs_error", error=str(e)))
         st.session_state.organizations = []
 
     # Load per-organization admin passwords
-    if os.path.exists(ORG_PASSWORD_FILE):
-        try:
-            pw_df = pd.read_csv(ORG_PASSWORD_FILE, dtype=str).fillna("")
-            if "Org" in pw_df.columns and "Password" in pw_df.columns:
-                st.session_state.org_admin_passwords = dict(zip(pw_df["Org"], pw_df["Password"]))
-            else:
-                st.session_state.org_admin_passwords = {}
-        except Exception:
-            st.session_state.org_admin_passwords = {}
-    else:
+    try:
+        st.session_state.org_admin_passwords = repo.load_org_passwords()
+    except Exception:
         st.session_state.org_admin_passwords = {}
 
 def save_data():
+    # Only tables flagged with mark_dirty() are normalized and flushed, all in
+    # one repository write so a multi-table change lands together
+    dirty = st.session_state.dirty_tables
+    if not dirty:
+        return
+    tables = {}
     try:
-        if "Phone" in st.session_state.users:
-            st.session_state.users["Phone"] = st.session_state.users["Phone"].apply(lambda x: clean_phone(x))
-        if "Email" in st.session_state.users:
-            st.session_state.users["Email"] = st.session_state.users["Email"].apply(lambda x: str(x).strip().lower() if x else "")
-
-        if "Phone" in st.session_state.attendance:
-            st.session_state.attendance["Phone"] = st.session_state.attendance["Phone"].apply(clean_phone)
-        if "Email" in st.session_state.attendance:
-            st.session_state.attendance["Email"] = st.session_state.attendance["Email"].apply(lambda x: str(x).strip().lower() if x else "")
-
-        st.session_state.users.to_csv(USERS_FILE, index=False)
-        st.session_state.attendance.to_csv(ATTENDANCE_FILE, index=False)
-        with open(ORG_FILE, 'w', encoding='utf-8') as f:
-            f.write("\n".join(st.session_state.organizations))
+        # Typed frames go back to strings only here, at the file boundary
+        if USERS_TABLE in dirty:
+            users = USERS_SCHEMA.expand(st.session_state.users.frame())
+            if "Phone" in users:
+                users["Phone"] = clean_phone_series(users["Phone"])
+            if "Email" in users:
+                users["Email"] = normalize_email_series(users["Email"])
+            tables[USERS_TABLE] = users
+
+        if ATTENDANCE_TABLE in dirty:
+            att = ATTENDANCE_SCHEMA.expand(st.session_state.attendance.frame())
+            if "Phone" in att:
+                att["Phone"] = clean_phone_series(att["Phone"])
+            if "Email" in att:
+                att["Email"] = normalize_email_series(att["Email"])
+            tables[ATTENDANCE_TABLE] = att
+
+        if ORGS_TABLE in dirty:
+            tables[ORGS_TABLE] = organizations_frame(st.session_state.organizations)
 
         # Save per-org admin passwords
-        pd.DataFrame([
-            {"Org": org, "Password": pw}
-            for org, pw in st.session_state.org_admin_passwords.items()
-        ]).to_csv(ORG_PASSWORD_FILE, index=False)
+        if ORG_PASSWORDS_TABLE in dirty:
+            tables[ORG_PASSWORDS_TABLE] = org_passwords_frame(st.session_state.org_admin_passwords)
+
+        get_repository().save_tables(tables)
+        dirty.difference_update(tables)
     except Exception as e:
         st.error(tr("save_error", error=str(e)))
 
@@ -408,9 +498,9 @@ def save_data():
 if 'language' not in st.session_state:
     st.session_state.language = "English"
 if 'users' not in st.session_state:
-    st.session_state.users = pd.DataFrame(columns=["Email", "Phone", "Name", "Gender", "Age", "Address", "Org", "Role"])
+    st.session_state.users = RowBuffer(columns=USER_COLUMNS, schema=USERS_SCHEMA)
 if 'attendance' not in st.session_state:
-    st.session_state.attendance = pd.DataFrame(columns=["Email", "Phone", "Name", "Org", "Clock In Date", "Time", "Clock Out Time"])
+    st.session_state.attendance = RowBuffer(columns=ATTENDANCE_COLUMNS, schema=ATTENDANCE_SCHEMA)
 if 'organizations' not in st.session_state:
     st.session_state.organizations = []
 if 'logged_in_user' not in st.session_state:
@@ -421,6 +511,14 @@ if 'admin_authenticated' not in st.session_state:
     st.session_state.admin_authenticated = False
 if 'org_admin_passwords' not in st.session_state:
     st.session_state.org_admin_passwords = {}
+if 'dirty_tables' not in st.session_state:
+    st.session_state.dirty_tables = set()
+if 'user_index' not in st.session_state:
+    st.session_state.user_index = new_user_index()
+if 'user_index_shared' not in st.session_state:
+    st.session_state.user_index_shared = False
+if 'versions' not in st.session_state:
+    st.session_state.versions = {}
 if 'admin_password' not in st.session_state:
     st.session_state.admin_password = DEFAULT_ADMIN_PASSWORD
 
@@ -431,11 +529,22 @@ def get_user(identifier):
     identifier_norm = normalize_identifier(identifier)
     if identifier_norm == "":
         return pd.DataFrame()
-    users = st.session_state.users.copy()
-    users["Email_norm"] = users["Email"].apply(lambda x: normalize_identifier(x))
-    users["Phone_norm"] = users["Phone"].apply(lambda x: normalize_identifier(x))
-    match = users[(users["Email_norm"] == identifier_norm) | (users["Phone_norm"] == identifier_norm)]
-    return match.drop(columns=["Email_norm", "Phone_norm"], errors="ignore")
+    index = st.session_state.user_index
+    labels = {index["email"].get(identifier_norm), index["phone"].get(identifier_norm)} - {None}
+    if not labels:
+        return pd.DataFrame()
+    return USERS_SCHEMA.expand(st.session_state.users.view().loc[sorted(labels)])
+
+def find_user_label(email, phone):
+    # Row label of the user whose stored Email and Phone are exactly these, or None
+    index = st.session_state.user_index
+    label = index["email"].get(normalize_identifier(email)) if email else index["phone"].get(normalize_identifier(phone))
+    if label is None:
+        return None
+    row = st.session_state.users.view().loc[label]
+    if row["Email"] != email or row["Phone"] != phone:
+        return None
+    return label
 
 def get_user_by_row(row):
     if row is None:
@@ -448,9 +557,28 @@ def get_user_by_row(row):
         "Age": row.get("Age", ""),
         "Address": row.get("Address", ""),
         "Org": row.get("Org", ""),
-        "Role": row.get("Role", "")
+        "Role": row.get("Role", ""),
+        "User ID": row.get("User ID", "")
     }
 
+def refresh_logged_in_user():
+    # After a reload that may have rewritten users (restore, org relabel), take
+    # the logged-in user's details from the users table again, by User ID and
+    # else by email/phone; a user who is gone is logged out
+    user = st.session_state.logged_in_user
+    if not user:
+        return
+    users = st.session_state.users.view()
+    match = users[users["User ID"] == user["User ID"]] if user.get("User ID") else users.iloc[:0]
+    if match.empty:
+        match = get_user(user.get("Email") or user.get("Phone") or "")
+    if match.empty:
+        st.session_state.logged_in_user = None
+        st.session_state.admin_authenticated = False
+        st.warning(tr("user_not_found"))
+        return
+    st.session_state.logged_in_user = get_user_by_row(USERS_SCHEMA.expand(match.iloc[:1]).iloc[0])
+
 def get_normalized_id_from_user_dict(user):
     if not user:
         return ""
@@ -461,9 +589,10 @@ def get_normalized_id_from_user_dict(user):
     return ""
 
 def get_admins_for_org(org):
-    admins = st.session_state.users[
-        (st.session_state.users["Org"] == org) &
-        (st.session_state.users["Role"].str.lower() == "admin")
+    users = st.session_state.users.view()
+    admins = users[
+        (users["Org"] == org) &
+        (users["Role"].str.lower() == "admin")
     ]
     if admins.empty:
         return []
@@ -483,7 +612,7 @@ def reset_user_password_ui():
     email = st.text_input(tr("password_reset_email"), key="reset_email")
     if not email:
         return False
-    if email not in st.session_state.users['Email'].values:
+    if normalize_identifier(email) not in st.session_state.user_index["email"]:
         st.error(tr("user_not_found"))
         return False
 
@@ -504,40 +633,48 @@ def validate_password(password):
 
 # === Registration ===
 def register_user(email, phone, name, gender, age, address, org, role="user"):
+    # True once the user is saved; otherwise a warning/error has been shown
     email_norm = str(email).strip().lower() if email and "@" in str(email) else ""
     phone_norm = clean_phone(phone)
 
     if email_norm == "" and phone_norm == "":
         st.warning(tr("either_email_phone_required"))
-        return
+        return False
 
-    users = st.session_state.users.copy()
-    users["Email_norm"] = users["Email"].apply(lambda x: normalize_identifier(x))
-    users["Phone_norm"] = users["Phone"].apply(lambda x: normalize_identifier(x))
-    if ((email_norm and (users["Email_norm"] == email_norm).any()) or
-            (phone_norm and (users["Phone_norm"] == phone_norm).any())):
+    with locked_write():
+        # Quick check on this session's index; the writer checks again against the latest users
+        index = st.session_state.user_index
+        if (email_norm and email_norm in index["email"]) or (phone_norm and phone_norm in index["phone"]):
+            st.warning(tr("user_exists"))
+            return False
+
+        if org and org not in st.session_state.organizations:
+            st.session_state.organizations.append(org)
+            # create default admin password for new org
+            st.session_state.org_admin_passwords[org] = st.session_state.org_admin_passwords.get(org, DEFAULT_ADMIN_PASSWORD)
+            mark_dirty(ORGS_TABLE, ORG_PASSWORDS_TABLE)
+
+        new_row = {
+            "Email": email_norm,
+            "Phone": phone_norm,
+            "Name": name.strip() if name else "",
+            "Gender": gender if gender else "",
+            "Age": str(age) if age != "" else "",
+            "Address": address if address else "",
+            "Org": org if org else "",
+            "Role": role,
+            "User ID": new_user_id()
+        }
+
+    # The next run's load_data() picks the new user up from the repository
+    added = commit_write(ADD_USER, new_row)
+    if added is None:
+        return False
+    if not added:
         st.warning(tr("user_exists"))
-        return
-
-    if org and org not in st.session_state.organizations:
-        st.session_state.organizations.append(org)
-        # create default admin password for new org
-        st.session_state.org_admin_passwords[org] = st.session_state.org_admin_passwords.get(org, DEFAULT_ADMIN_PASSWORD)
-
-    new_row = {
-        "Email": email_norm,
-        "Phone": phone_norm,
-        "Name": name.strip() if name else "",
-        "Gender": gender if gender else "",
-        "Age": str(age) if age != "" else "",
-        "Address": address if address else "",
-        "Org": org if org else "",
-        "Role": role
-    }
-
-    st.session_state.users = pd.concat([st.session_state.users, pd.DataFrame([new_row])], ignore_index=True)
-    save_data()
+        return False
     st.success(tr("registered_success", role=role))
+    return True
 
 # === Login ===
 def login_ui():
@@ -560,22 +697,56 @@ def logout():
     st.rerun()
 
 # === Profile Edit Functions ===
-def update_attendance_records(old_email, old_phone, new_email, new_phone, new_name, new_org):
-    if old_email:
-        mask = st.session_state.attendance["Email"] == old_email
-        st.session_state.attendance.loc[mask, "Email"] = new_email
-        st.session_state.attendance.loc[mask, "Phone"] = new_phone
-        st.session_state.attendance.loc[mask, "Name"] = new_name
-        st.session_state.attendance.loc[mask, "Org"] = new_org
-
-    if old_phone:
-        mask = st.session_state.attendance["Phone"] == old_phone
-        st.session_state.attendance.loc[mask, "Email"] = new_email
-        st.session_state.attendance.loc[mask, "Phone"] = new_phone
-        st.session_state.attendance.loc[mask, "Name"] = new_name
-        st.session_state.attendance.loc[mask, "Org"] = new_org
-
-    save_data()
+def move_attendance_org(user_id, new_org):
+    # Attendance rows reference their user by User ID, so email/phone/name edits
+    # leave them alone; only a change of org moves the user's records
+    attendance = st.session_state.attendance.frame()
+    mask = attendance["User ID"] == user_id
+    if user_id and mask.any():
+        ATTENDANCE_SCHEMA.assign(attendance, mask, "Org", new_org)
+        mark_dirty(ATTENDANCE_TABLE)
+
+def with_user_ids(current, accepted):
+    # accepted rows as users: those the roster diff matches to a current user keep
+    # that user's ID (and so their attendance), the rest get new ones
+    diff = diff_roster(current, accepted)
+    accepted = accepted.copy()
+    accepted["User ID"] = [new_user_id() for _ in range(len(accepted))]
+    accepted.loc[diff.matches.index, "User ID"] = current.loc[diff.matches, "User ID"].to_numpy()
+    return accepted
+
+def apply_roster_diff(org, accepted):
+    # Recomputed here, under the write lock, so it applies to the latest roster.
+    # Updates and inserts touch only the changed rows and index entries; only
+    # deletes renumber the table, which rebuilds the index.
+    users = st.session_state.users.frame()
+    diff = diff_roster(USERS_SCHEMA.expand(users[users["Org"] == org]), accepted)
+    if diff.empty:
+        return diff
+    index = writable_user_index()
+
+    if not diff.updates.empty:
+        # Updated users keep their User ID, so their attendance needs no rewrite
+        labels = diff.updates["Label"].to_numpy()
+        for column in DIFF_COLUMNS:
+            USERS_SCHEMA.assign(users, labels, column, diff.updates[column].to_numpy())
+        for row in diff.updates.to_dict("records"):
+            remove_from_user_index(index, row["Label"], row["Old Email"], row["Old Phone"])
+            add_to_user_index(index, row["Label"], row["Email"], row["Phone"])
+
+    if not diff.deletes.empty:
+        kept = users.drop(index=diff.deletes.index).reset_index(drop=True)
+        st.session_state.users = RowBuffer(kept, schema=USERS_SCHEMA)
+        st.session_state.user_index = index = build_user_index(kept)
+
+    inserts = diff.inserts.to_dict("records")
+    for row in inserts:
+        row["User ID"] = new_user_id()
+    for label, row in zip(st.session_state.users.extend(inserts), inserts):
+        add_to_user_index(index, label, row["Email"], row["Phone"])
+
+    mark_dirty(USERS_TABLE)
+    return diff
 
 # === Profile Edit ===
 def edit_profile(user):
@@ -601,24 +772,30 @@ def edit_profile(user):
         org = st.text_input(tr("organization_label"), value=user.get("Org", ""))
 
     if st.button(tr("save_changes_button")):
-        idx = st.session_state.users[
-            (st.session_state.users["Email"] == old_email) &
-            (st.session_state.users["Phone"] == old_phone)
-        ].index
-
-        if not idx.empty:
-            old_name = user.get("Name", "")
-            old_org = user.get("Org", "")
-
-            st.session_state.users.loc[idx[0], ["Email", "Phone", "Name", "Gender", "Age", "Address", "Org"]] = [
-                email, phone, name, gender, str(age), address, org
-            ]
-
-            if email != old_email or phone != old_phone or name != old_name or org != old_org:
-                update_attendance_records(old_email, old_phone, email, phone, name, org)
-
-            save_data()
-            st.session_state.logged_in_user = get_user_by_row(st.session_state.users.loc[idx[0]])
+        # Store what save_data() would write, so the session frame, the index
+        # and logged_in_user keep matching the saved row on the next edit
+        email = normalize_email(email)
+        phone = clean_phone(phone)
+        with locked_write():
+            label = find_user_label(old_email, old_phone)
+
+            if label is not None:
+                old_org = user.get("Org", "")
+
+                users = st.session_state.users.frame()
+                for column, value in zip(["Email", "Phone", "Name", "Gender", "Age", "Address", "Org"],
+                                         [email, phone, name, gender, str(age), address, org]):
+                    USERS_SCHEMA.assign(users, label, column, value)
+                index = writable_user_index()
+                remove_from_user_index(index, label, old_email, old_phone)
+                add_to_user_index(index, label, email, phone)
+
+                if org != old_org:
+                    move_attendance_org(users.loc[label, "User ID"], org)
+
+                mark_dirty(USERS_TABLE)
+        if label is not None:
+            st.session_state.logged_in_user = get_user_by_row(USERS_SCHEMA.expand(st.session_state.users.frame().loc[[label]]).iloc[0])
             st.success(tr("profile_updated"))
         else:
             st.error(tr("user_not_found"))
@@ -637,17 +814,6 @@ def clock_in_user(user):
         st.error(tr("user_identifier_missing"))
         return
 
-    attendance_df = st.session_state.attendance.copy()
-    match = attendance_df[
-        (attendance_df["Email"] == (user.get("Email") or "")) &
-        (attendance_df["Phone"] == (user.get("Phone") or "")) &
-        (attendance_df["Clock In Date"] == today) &
-        (attendance_df["Org"] == (user.get("Org") or ""))
-    ]
-    if not match.empty:
-        st.info(tr("already_clocked_in"))
-        return
-
     new_row = {
         "Email": user.get("Email", ""),
         "Phone": user.get("Phone", ""),
@@ -655,11 +821,18 @@ def clock_in_user(user):
         "Org": user.get("Org", ""),
         "Clock In Date": today,
         "Time": now.strftime("%H:%M:%S"),
-        "Clock Out Time": ""
+        "Clock Out Time": "",
+        "User ID": user.get("User ID", "")
     }
 
-    st.session_state.attendance = pd.concat([attendance_df, pd.DataFrame([new_row])], ignore_index=True)
-    save_data()
+    # Views read attendance through the repository, so the session snapshot
+    # is simply refreshed on the next run
+    clocked_in = commit_write(CLOCK_IN, new_row)
+    if clocked_in is None:
+        return
+    if not clocked_in:
+        st.info(tr("already_clocked_in"))
+        return
     st.success(tr("clockin_success"))
 
 def clock_out_user(user):
@@ -671,26 +844,206 @@ def clock_out_user(user):
     now = datetime.now(malaysia_tz)
     today = str(now.date())
 
-    attendance_df = st.session_state.attendance.copy()
-    today_records = attendance_df[
-        (attendance_df["Email"] == (user.get("Email") or "")) &
-        (attendance_df["Phone"] == (user.get("Phone") or "")) &
-        (attendance_df["Clock In Date"] == today) &
-        (attendance_df["Org"] == (user.get("Org") or ""))
-    ]
+    status = commit_write(CLOCK_OUT, shift_key(user, today), now.strftime("%H:%M:%S"))
+    if status is None:
+        return
 
-    if today_records.empty:
+    if status == NO_ACTIVE_CLOCK_IN:
         st.warning(tr("no_active_clockin"))
         return
 
-    if (today_records["Clock Out Time"] != "").any():
+    if status == ALREADY_CLOCKED_OUT:
         st.info(tr("already_clocked_out"))
         return
 
-    st.session_state.attendance.loc[today_records.index, "Clock Out Time"] = now.strftime("%H:%M:%S")
-    save_data()
     st.success(tr("clockout_success"))
 
+def relabel_orgs(mapping):
+    # Rename ({old: new}), delete-with-transfer and combine are all an org relabel.
+    # Call inside locked_write(): the repository applies it to all four tables in
+    # one write (on SQLite, UPDATEs of just the affected rows and rollups; on CSV, a
+    # relabel of the cached Org categories and indexes) and the session then reloads them
+    get_repository().relabel_orgs(mapping)
+    load_data()
+    refresh_logged_in_user()
+
+def set_history_page(page):
+    st.session_state.my_page = page
+
+def my_attendance(user):
+    # One page of the user's own records, newest first, optionally one month;
+    # the repository serves it from the per-person history index
+    repo = get_repository()
+    identity = (user.get("User ID") or "", user.get("Org") or "")
+    month = st.session_state.get("my_month")
+    if st.session_state.get("my_view") != (identity, month):
+        st.session_state.my_view = (identity, month)
+        st.session_state.my_page = 1
+    page = st.session_state.my_page
+    rows, total, months = repo.user_attendance_page(*identity, month=month,
+                                                    offset=(page - 1) * HISTORY_PAGE_SIZE, limit=HISTORY_PAGE_SIZE)
+    if not months:
+        st.info(tr("no_records"))
+        return
+
+    options = [None] + months
+    if month not in options:
+        month = st.session_state.my_month = None
+    st.selectbox("Month", options, format_func=lambda m: "All months" if m is None else m, key="my_month")
+    pages = max(1, -(-total // HISTORY_PAGE_SIZE))
+    st.dataframe(rows.reset_index(drop=True))
+    prev_col, info_col, next_col = st.columns([1, 3, 1])
+    prev_col.button("◀ Newer", disabled=page <= 1, on_click=set_history_page, args=(page - 1,), key="my_prev")
+    info_col.caption(f"{total} records · page {page} of {pages}")
+    next_col.button("Older ▶", disabled=page >= pages, on_click=set_history_page, args=(page + 1,), key="my_next")
+
+def set_attendance_page(page):
+    st.session_state.att_page = page
+
+def attendance_explorer(repo, org):
+    # Filters, sorting and paging are evaluated by the repository; only the
+    # visible page reaches st.dataframe
+    col1, col2, col3 = st.columns(3)
+    dates = col1.date_input("Clock-in dates", value=(), key="att_dates")
+    name = col2.text_input("Name contains", key="att_name")
+    open_only = col3.checkbox("Open shifts only", key="att_open")
+    col4, col5, col6 = st.columns(3)
+    sort_by = col4.selectbox("Sort by", ATTENDANCE_SORT_COLUMNS, key="att_sort")
+    descending = col5.checkbox("Descending", value=True, key="att_desc")
+    page_size = col6.selectbox("Rows per page", ATTENDANCE_PAGE_SIZES, index=1, key="att_page_size")
+
+    dates = list(dates) if isinstance(dates, (list, tuple)) else [dates]
+    filters = {
+        "start_date": dates[0].strftime("%Y-%m-%d") if dates else None,
+        "end_date": dates[-1].strftime("%Y-%m-%d") if dates else None,
+        "name": name.strip(),
+        "open_only": open_only,
+        "sort_by": sort_by,
+        "descending": descending,
+    }
+    # Any change to the filters starts over at the first page
+    if st.session_state.get("att_filters") != (org, filters, page_size):
+        st.session_state.att_filters = (org, filters, page_size)
+        st.session_state.att_page = 1
+
+    page = st.session_state.att_page
+    rows, total = repo.org_attendance_page(org, offset=(page - 1) * page_size, limit=page_size, **filters)
+    pages = max(1, -(-total // page_size))
+    if page > pages:
+        # The data shrank under this page (e.g. another admin's change)
+        page = st.session_state.att_page = pages
+        rows, total = repo.org_attendance_page(org, offset=(page - 1) * page_size, limit=page_size, **filters)
+
+    first = (page - 1) * page_size
+    rows = rows.reset_index(drop=True)
+    rows.index = rows.index + first + 1
+    st.dataframe(rows)
+    prev_col, info_col, next_col = st.columns([1, 3, 1])
+    prev_col.button("◀ Previous", disabled=page <= 1, on_click=set_attendance_page, args=(page - 1,), key="att_prev")
+    info_col.caption(f"Rows {first + 1 if total else 0}–{first + len(rows)} of {total} · page {page} of {pages}")
+    next_col.button("Next ▶", disabled=page >= pages, on_click=set_attendance_page, args=(page + 1,), key="att_next")
+
+@st.cache_data(max_entries=32)
+def org_users_csv_bytes(org, version):
+    # version is the users table's repo.versions() stamp: any write to the table
+    # changes the key, so bytes are only re-serialized after the data changed
+    return get_repository().org_users(org).to_csv(index=False).encode("utf-8")
+
+@st.cache_data(max_entries=16)
+def org_attendance_export(org, version, fmt, start_date, end_date):
+    # Keyed like org_users_csv_bytes (on the attendance and users versions, as
+    # Email/Phone/Name are the users' current ones), plus the format and date range
+    repo = get_repository()
+    att = repo.current_user_details(in_date_range(repo.org_attendance(org), start_date, end_date))
+    span = f"_{start_date}_{end_date}" if start_date else ""
+    return export_bytes(att, fmt, f"{org}_attendance{span}")
+
+@st.cache_data(max_entries=16)
+def org_timesheet(org, version, period, start_date, end_date, late_after, today):
+    # Per-user and org-wide totals, cached per (org, data version, period, filters);
+    # today is part of the key because it decides which open shifts are missing a clock-out
+    repo = get_repository()
+    att = repo.current_user_details(in_date_range(repo.org_attendance(org), start_date, end_date))
+    shifts = timesheet.shifts(att, today, late_after)
+    return timesheet.totals(shifts, period), timesheet.totals(shifts, period, by_user=False)
+
+@st.cache_data(max_entries=16)
+def org_timesheet_csv(org, version, period, start_date, end_date, late_after, today):
+    by_user = org_timesheet(org, version, period, start_date, end_date, late_after, today)[0]
+    return by_user.to_csv(index=False).encode("utf-8")
+
+def attendance_summary(repo, org):
+    # Reads only the rollups (one row per day, and per user and month), so its
+    # cost does not grow with the length of the attendance history
+    col1, col2 = st.columns(2)
+    dates = col1.date_input("Summary dates (all if empty)", value=(), key="sum_dates")
+    dates = list(dates) if isinstance(dates, (list, tuple)) else [dates]
+    daily = repo.org_daily_rollup(org,
+                                  dates[0].strftime("%Y-%m-%d") if dates else None,
+                                  dates[-1].strftime("%Y-%m-%d") if dates else None)
+    if daily.empty:
+        st.info(tr("no_records"))
+        return
+    shifts_col, hours_col, open_col = st.columns(3)
+    shifts_col.metric("Shifts", int(daily["Present"].sum()))
+    hours_col.metric("Hours worked", round(float(daily["Minutes"].sum()) / 60, 1))
+    open_col.metric("Open shifts", int(daily["Open"].sum()))
+    st.bar_chart(daily.set_index("Date")["Present"])
+
+    months = sorted(set(daily["Date"].str.slice(0, 7)) - {""}, reverse=True)
+    month = col2.selectbox("Month", months, key="sum_month")
+    monthly = repo.org_monthly_rollup(org, month)
+    users = repo.org_users(org)
+    monthly.insert(1, "Name", monthly["User ID"].map(dict(zip(users["User ID"], users["Name"]))).fillna(""))
+    monthly.insert(monthly.columns.get_loc("Minutes"), "Hours", (monthly.pop("Minutes") / 60).round(2))
+    st.dataframe(monthly)
+    st.download_button(f"Download {month} summary CSV", monthly.to_csv(index=False).encode("utf-8"),
+                       f"{org}_summary_{month}.csv", "text/csv", key="sum_download")
+
+def timesheet_view(org, version):
+    col1, col2, col3 = st.columns(3)
+    period = col1.selectbox("Period", timesheet.PERIODS, index=1, format_func=timesheet.PERIOD_LABELS.get, key="ts_period")
+    dates = col2.date_input("Timesheet dates (all if empty)", value=(), key="ts_dates")
+    late_after = col3.time_input("Late after", value=datetime.strptime(timesheet.DEFAULT_LATE_AFTER, "%H:%M:%S").time(),
+                                 key="ts_late_after")
+    dates = list(dates) if isinstance(dates, (list, tuple)) else [dates]
+    today = str(datetime.now(pytz.timezone("Asia/Kuala_Lumpur")).date())
+    key = (org, version, period,
+           dates[0].strftime("%Y-%m-%d") if dates else None,
+           dates[-1].strftime("%Y-%m-%d") if dates else None,
+           late_after.strftime("%H:%M:%S"), today)
+    by_user, overall = org_timesheet(*key)
+    if overall.empty:
+        st.info(tr("no_records"))
+        return
+    st.dataframe(overall)
+    with st.expander(f"Per user ({len(by_user)} rows)"):
+        st.dataframe(by_user)
+        st.download_button("Download timesheet CSV", org_timesheet_csv(*key),
+                           f"{org}_timesheet_{period}.csv", "text/csv", key="ts_download")
+
+def clear_attendance_export():
+    st.session_state.att_export = None
+
+def clear_backup_download():
+    st.session_state.backup_download = None
+
+def attendance_export(org, version):
+    # Nothing is serialized until the admin asks for a file; the bytes are
+    # then cached per (org, version, format, date range)
+    col1, col2 = st.columns(2)
+    fmt = col1.selectbox("Export format", available_formats(), format_func=FORMAT_LABELS.get, key="att_export_format")
+    dates = col2.date_input("Export dates (all if empty)", value=(), key="att_export_dates")
+    dates = list(dates) if isinstance(dates, (list, tuple)) else [dates]
+    request = (org, fmt,
+               dates[0].strftime("%Y-%m-%d") if dates else None,
+               dates[-1].strftime("%Y-%m-%d") if dates else None)
+    if st.button(f"Prepare {org} attendance export", key="att_export_prepare"):
+        st.session_state.att_export = request
+    if st.session_state.get("att_export") == request:
+        data, file_name, mime = org_attendance_export(org, version, fmt, request[2], request[3])
+        st.download_button(f"⬇ {file_name}", data, file_name, mime, on_click=clear_attendance_export)
+
 # === Admin view with upload, backup, restore ===
 def admin_view(user):
     if not user or user.get("Role", "").lower() != "admin":
@@ -716,29 +1069,25 @@ def admin_view(user):
 
     # Show only this org's attendance
     st.subheader(tr("attendance_records_org", org=org))
-    org_attendance = st.session_state.attendance[
-        st.session_state.attendance["Org"] == org
-    ].reset_index(drop=True)
+    repo = get_repository()
+    versions = repo.versions()
+    attendance_explorer(repo, org)
+    attendance_export(org, (versions[ATTENDANCE_TABLE], versions[USERS_TABLE]))
 
-    st.dataframe(org_attendance)
-    csv = org_attendance.to_csv(index=False).encode('utf-8')
-    st.download_button(
-        tr("download_att_csv", org=org),
-        csv,
-        f"{org}_attendance.csv",
-        "text/csv"
-    )
+    st.markdown("### Attendance summary")
+    attendance_summary(repo, org)
+
+    st.markdown("### Timesheets")
+    timesheet_view(org, (versions[ATTENDANCE_TABLE], versions[USERS_TABLE]))
 
     st.markdown("---")
 
     # User management section (with download)
     st.subheader(tr("user_management_org", org=org))
-    org_users = st.session_state.users[
-        st.session_state.users["Org"] == org
-    ].reset_index(drop=True)
+    org_users = repo.org_users(org).reset_index(drop=True)
 
     st.dataframe(org_users)
-    csv_users = org_users.to_csv(index=False).encode('utf-8')
+    csv_users = org_users_csv_bytes(org, versions[USERS_TABLE])
     st.download_button(
         tr("download_users_csv", org=org),
         csv_users,
@@ -749,85 +1098,139 @@ def admin_view(user):
     st.markdown("### " + tr("upload_replace_header"))
     uploaded_file = st.file_uploader(tr("upload_replace_header"), type="csv", help="CSV must include columns: Name, Org and Email or Phone")
     if uploaded_file:
-        try:
-            df_new = pd.read_csv(uploaded_file, dtype=str).fillna("")
-        except Exception as e:
-            st.error(f"Error reading CSV: {e}")
-            df_new = None
-
-        if df_new is not None:
-            # validate required columns
-            has_name = "Name" in df_new.columns
-            has_org = "Org" in df_new.columns
-            has_email_or_phone = ("Email" in df_new.columns) or ("Phone" in df_new.columns)
-            if not (has_name and has_org and has_email_or_phone):
+        # Option: filter to this org only
+        filter_org = st.checkbox(f"Only use rows where Org == {org} (recommended)", value=True)
+        # Streamed and validated once per upload; reruns reuse the result
+        import_key = (uploaded_file.file_id, filter_org, st.session_state.versions[USERS_TABLE])
+        cached_import = st.session_state.get("roster_import")
+        if cached_import is None or cached_import[0] != import_key:
+            taken_emails, taken_phones = existing_identifiers(st.session_state.users.view(), exclude_org=org)
+            try:
+                uploaded_file.seek(0)
+                result = import_roster(uploaded_file, taken_emails, taken_phones, org=org if filter_org else None)
+            except MissingColumnsError:
                 st.error(tr("upload_error_missing_columns"))
-            else:
-                # only consider rows matching this org (or allow admin to upload full org dataset)
-                st.write(f"Uploaded rows: {len(df_new)}")
-                # Option: filter to this org only
-                filter_org = st.checkbox(f"Only use rows where Org == {org} (recommended)", value=True)
-                if filter_org:
-                    df_new_org = df_new[df_new["Org"] == org].copy()
-                else:
-                    df_new_org = df_new.copy()
-
-                st.write(f"Rows to import for this org: {len(df_new_org)}")
-
-                confirm = st.checkbox(tr("confirm_replace_checkbox"))
-                if confirm and st.button(tr("replace_now")):
+                result = None
+            except Exception as e:
+                st.error(f"Error reading CSV: {e}")
+                result = None
+            st.session_state.roster_import = (import_key, result)
+        result = st.session_state.roster_import[1]
+
+        if result is not None:
+            st.write(f"Uploaded rows: {result.total_rows}")
+            if filter_org:
+                st.write(f"Rows for other orgs (ignored): {result.skipped_rows}")
+            st.write(f"Rows to import for this org: {result.accepted_rows}")
+            if result.rejected_rows:
+                st.warning(f"Rejected rows: {result.rejected_rows}")
+                st.dataframe(result.rejected.head(100))
+                st.download_button(
+                    "Download reject report",
+                    result.reject_report_csv(),
+                    f"{org}_import_rejects.csv",
+                    "text/csv"
+                )
+
+            # Preview what the upload changes in this org's roster
+            users_now = st.session_state.users.view()
+            diff = diff_roster(USERS_SCHEMA.expand(users_now[users_now["Org"] == org]), result.accepted)
+            st.write(f"New users: {len(diff.inserts)} · Updated: {len(diff.updates)} · "
+                     f"Removed: {len(diff.deletes)} · Unchanged: {diff.unchanged}")
+            for label, rows in (("New users", diff.inserts), ("Updated users", diff.updates), ("Removed users", diff.deletes)):
+                if not rows.empty:
+                    with st.expander(f"{label} ({len(rows)})"):
+                        st.dataframe(rows.head(100))
+            apply_diff = st.radio(
+                "Import mode",
+                ["Apply only these changes", "Replace all users of this org"],
+            ) == "Apply only these changes"
+
+            confirm = st.checkbox(tr("confirm_replace_checkbox"))
+            if confirm and st.button(tr("replace_now")):
+                df_new_org = result.accepted
+                with locked_write():
                     # Backup current users file
-                    backup_file = backup_users()
-                    # Replace only this org's users while keeping other orgs intact
-                    others = st.session_state.users[st.session_state.users["Org"] != org].copy()
-                    # Normalize uploaded columns to match schema
-                    # Ensure all expected columns exist in df_new_org
-                    for col in ["Email", "Phone", "Name", "Gender", "Age", "Address", "Org", "Role"]:
-                        if col not in df_new_org.columns:
-                            df_new_org[col] = ""
-                    # normalize email/phone
-                    df_new_org["Email"] = df_new_org["Email"].apply(lambda x: str(x).strip().lower() if x else "")
-                    df_new_org["Phone"] = df_new_org["Phone"].apply(lambda x: clean_phone(x))
-                    # Compose new users df
-                    new_users_df = pd.concat([others, df_new_org[["Email", "Phone", "Name", "Gender", "Age", "Address", "Org", "Role"]]], ignore_index=True)
-                    st.session_state.users = new_users_df
+                    backup_file = backup_all(note=f"before roster upload for {org}")
+                    if apply_diff:
+                        diff = apply_roster_diff(org, df_new_org)
+                    else:
+                        # Replace only this org's users while keeping other orgs intact
+                        users = st.session_state.users.frame()
+                        others = users[users["Org"] != org].copy()
+                        # Compose new users df; accepted rows are already normalized to ROSTER_COLUMNS
+                        df_new_org = with_user_ids(USERS_SCHEMA.expand(users[users["Org"] == org]), df_new_org)
+                        new_users_df = pd.concat([USERS_SCHEMA.expand(others), df_new_org], ignore_index=True)
+                        st.session_state.users = RowBuffer(USERS_SCHEMA.compact(new_users_df), schema=USERS_SCHEMA)
+                        st.session_state.user_index = build_user_index(new_users_df)
+                        st.session_state.user_index_shared = False
+                        mark_dirty(USERS_TABLE)
                     # Ensure organizations list includes uploaded orgs
                     uploaded_orgs = sorted(set([o for o in df_new_org["Org"].unique() if str(o).strip() != ""]))
                     for o in uploaded_orgs:
                         if o not in st.session_state.organizations:
                             st.session_state.organizations.append(o)
                             st.session_state.org_admin_passwords[o] = st.session_state.org_admin_passwords.get(o, DEFAULT_ADMIN_PASSWORD)
-                    save_data()
-                    st.success(tr("backup_created", backup=backup_file))
+                            mark_dirty(ORGS_TABLE, ORG_PASSWORDS_TABLE)
+                st.session_state.roster_import = None
+                st.success(tr("backup_created", backup=backup_file))
+                if apply_diff:
+                    st.success(f"Updated users for org {org}: {len(diff.inserts)} added, "
+                               f"{len(diff.updates)} updated, {len(diff.deletes)} removed")
+                else:
                     st.success(f"Replaced users for org {org}. Imported rows: {len(df_new_org)}")
 
     # Backup management section
     st.markdown("### " + tr("manage_backups"))
     backups = list_backups()
-    if backups:
-        selected_backup = st.selectbox(tr("select_backup_restore"), backups)
+    if not backups.empty:
+        labels = {row.Set: f"{row.Created.replace('T', ' ')} · {row.Rows}" + (f" · {row.Note}" if row.Note else "")
+                  for row in backups.itertuples()}
+        selected_backup = st.selectbox(tr("select_backup_restore"), list(labels), format_func=labels.get)
         if st.button(tr("restore_success", backup="{backup}").split("{backup}")[0] + "Restore Selected Backup"):
-            backup_path = os.path.join(BACKUP_DIR, selected_backup)
             try:
-                restored = pd.read_csv(backup_path, dtype=str).fillna("")
-                # backup current before restore
-                pre_backup = backup_users()
-                st.session_state.users = restored[["Email", "Phone", "Name", "Gender", "Age", "Address", "Org", "Role"]].copy() if all(c in restored.columns for c in ["Email", "Phone", "Name", "Org"]) else restored
-                # update organizations from restored
-                restored_orgs = sorted(set([o for o in st.session_state.users["Org"].unique() if str(o).strip() != ""]))
-                for o in restored_orgs:
-                    if o not in st.session_state.organizations:
-                        st.session_state.organizations.append(o)
-                save_data()
-                st.success(tr("restore_success", backup=selected_backup))
+                restored = get_backup_store().restore_set(selected_backup)
+                repo = get_repository()
+                with locked_write():
+                    # backup current before restore
+                    tables = repo.export_tables()
+                    pre_backup = backup_all(note=f"before restoring {labels[selected_backup]}", tables=tables)
+                    # Older users-only backups leave the other tables as they are
+                    tables = dict(tables)
+                    if USERS_TABLE in restored:
+                        restored_users = restored[USERS_TABLE]
+                        if all(c in restored_users.columns for c in ["Email", "Phone", "Name", "Org"]):
+                            restored_users = restored_users.reindex(columns=USER_COLUMNS, fill_value="")
+                        restored[USERS_TABLE] = restored_users
+                        if ORGS_TABLE not in restored:
+                            # update organizations from restored
+                            orgs = list(st.session_state.organizations)
+                            orgs += sorted(set(o for o in restored_users["Org"].unique() if str(o).strip() != "") - set(orgs))
+                            restored[ORGS_TABLE] = organizations_frame(orgs)
+                    tables.update(restored)
+                    # Restored users without IDs (older backups) get new ones, relinked to their attendance
+                    users, att, _, _ = assign_user_ids(
+                        tables[USERS_TABLE].reindex(columns=USER_COLUMNS).fillna(""),
+                        tables[ATTENDANCE_TABLE].reindex(columns=ATTENDANCE_COLUMNS).fillna(""),
+                    )
+                    tables[USERS_TABLE], tables[ATTENDANCE_TABLE] = users, att
+                    repo.save_tables(tables)
+                    load_data()
+                    # The restored set may rename or drop this admin's org
+                    refresh_logged_in_user()
+                st.success(tr("restore_success", backup=labels[selected_backup]))
                 st.info(f"Made a pre-restore backup: {pre_backup}")
             except Exception as e:
                 st.error(f"Error restoring backup: {e}")
 
-        backup_path = os.path.join(BACKUP_DIR, selected_backup)
-        if os.path.exists(backup_path):
-            with open(backup_path, "rb") as f:
-                st.download_button(tr("download_backup"), f, file_name=selected_backup)
+        if selected_backup in labels:
+            # The zip is only built once asked for, like attendance_export()
+            if st.button("Prepare backup download", key="backup_prepare"):
+                st.session_state.backup_download = selected_backup
+            if st.session_state.get("backup_download") == selected_backup:
+                st.download_button(tr("download_backup"), backup_zip_bytes(selected_backup),
+                                   file_name=f"{selected_backup}.zip", mime="application/zip",
+                                   on_click=clear_backup_download)
     else:
         st.info("No backups available.")
 
@@ -837,10 +1240,9 @@ def admin_view(user):
     new_org_name = st.text_input(tr("rename_org_new_name"), value=org)
     if st.button(tr("rename_org_header")):
         if new_org_name and new_org_name != org:
-            st.session_state.organizations[st.session_state.organizations.index(org)] = new_org_name
-            st.session_state.users.loc[st.session_state.users["Org"] == org, "Org"] = new_org_name
-            st.session_state.attendance.loc[st.session_state.attendance["Org"] == org, "Org"] = new_org_name
-            save_data()
+            with locked_write():
+                backup_all(note=f"before renaming {org} to {new_org_name}")
+                relabel_orgs({org: new_org_name})
             st.success(tr("rename_org_success"))
         else:
             st.error(tr("rename_org_error"))
@@ -851,10 +1253,9 @@ def admin_view(user):
     transfer_to_org = st.selectbox(tr("delete_org_transfer"), st.session_state.organizations)
     if st.button(tr("delete_org_header")):
         if delete_org_name and delete_org_name != transfer_to_org:
-            st.session_state.users.loc[st.session_state.users["Org"] == delete_org_name, "Org"] = transfer_to_org
-            st.session_state.attendance.loc[st.session_state.attendance["Org"] == delete_org_name, "Org"] = transfer_to_org
-            st.session_state.organizations.remove(delete_org_name)
-            save_data()
+            with locked_write():
+                backup_all(note=f"before deleting {delete_org_name}")
+                relabel_orgs({delete_org_name: transfer_to_org})
             st.success(tr("delete_org_success"))
         else:
             st.error(tr("delete_org_error"))
@@ -867,12 +1268,9 @@ def admin_view(user):
     )
     if st.button(tr("combine_org_header")):
         if orgs_to_combine:
-            for combine_org in orgs_to_combine:
-                st.session_state.users.loc[st.session_state.users["Org"] == combine_org, "Org"] = org
-                st.session_state.attendance.loc[st.session_state.attendance["Org"] == combine_org, "Org"] = org
-                if combine_org in st.session_state.organizations:
-                    st.session_state.organizations.remove(combine_org)
-            save_data()
+            with locked_write():
+                backup_all(note=f"before combining {', '.join(orgs_to_combine)} into {org}")
+                relabel_orgs({combine_org: org for combine_org in orgs_to_combine})
             st.success(tr("combine_org_success"))
         else:
             st.error(tr("combine_org_error"))
@@ -896,8 +1294,9 @@ def admin_view(user):
         elif new_pwd == old_pwd:
             st.error(tr("pwd_same_old"))
         else:
-            st.session_state.org_admin_passwords[org] = new_pwd
-            save_data()
+            with locked_write():
+                st.session_state.org_admin_passwords[org] = new_pwd
+                mark_dirty(ORG_PASSWORDS_TABLE)
             st.success(tr("admin_pwd_changed"))
 
 # === App UI ===
@@ -962,11 +1361,9 @@ if not st.session_state.logged_in_user:
             if not org or not org.strip():
                 st.error(tr("create_org_empty"))
             else:
-                if org.strip() not in st.session_state.organizations:
-                    st.session_state.organizations.append(org.strip())
-                    st.session_state.org_admin_passwords[org.strip()] = DEFAULT_ADMIN_PASSWORD
+                # register_user() creates the org (with the default admin password)
+                # in its own locked block and reports the outcome itself
                 register_user(email, phone, name, gender, age, address, org.strip(), "admin")
-                st.success(tr("registered_success", role="admin"))
 
 else:
     # Logged in users
@@ -989,17 +1386,7 @@ else:
         st.markdown("---")
         st.subheader(tr("attendance_records"))
         # Show user's own attendance records
-        user = st.session_state.logged_in_user
-        user_attendance = st.session_state.attendance[
-            (st.session_state.attendance["Email"] == (user.get("Email") or "")) &
-            (st.session_state.attendance["Phone"] == (user.get("Phone") or "")) &
-            (st.session_state.attendance["Org"] == (user.get("Org") or ""))
-        ].sort_values(by=["Clock In Date", "Time"], ascending=[False, False])
-
-        if user_attendance.empty:
-            st.info(tr("no_records"))
-        else:
-            st.dataframe(user_attendance.reset_index(drop=True))
+        my_attendance(st.session_state.logged_in_user)
 
     elif menu == tr("admin_view"):
         admin_view(st.session_state.logged_in_user)
@@ -0,0 +1,80 @@
+"""The vectorized normalization functions must agree with their scalar versions.
+
+Run with ``python -m pytest test_normalization.py``.
+"""
+import random
+
+import pandas as pd
+import pytest
+
+from normalization import (
+    check,
+    clean_phone,
+    clean_phone_series,
+    normalize_email,
+    normalize_email_series,
+    normalize_identifier,
+    normalize_identifier_series,
+)
+
+SAMPLE_VALUES = [
+    "", " ", "0123456789", "60123456789", "+60 12-345 6789", "123456789", "60", "601",
+    "0123456789.0", "123456789.00", "12.5", "abc", "A@B.COM ", " x@y.z", "(012) 345 6789",
+    "6012345", "٠١٢٣٤٥٦٧٨٩", "600123456789", "1.0e9", "\u3000012 3456789\xa0", "İSTANBUL@X.COM",
+    "ß@STRASSE.DE", "０１２３４５６７８９",
+]
+
+
+def random_value(rng):
+    kind = rng.random()
+    if kind < 0.4:
+        return rng.choice(["", "+", "60", "0"]) + "".join(rng.choice("0123456789 -") for _ in range(rng.randint(0, 12)))
+    if kind < 0.6:
+        return f"{rng.randint(0, 10 ** 10)}" + rng.choice(["", ".0", ".00", ".5"])
+    if kind < 0.8:
+        return rng.choice(["", " "]) + "".join(rng.choice("abcXYZ._") for _ in range(rng.randint(1, 8))) + "@Example.COM" + rng.choice(["", " "])
+    return rng.choice(SAMPLE_VALUES)
+
+
+PAIRS = [
+    (normalize_email, normalize_email_series),
+    (clean_phone, clean_phone_series),
+    (normalize_identifier, normalize_identifier_series),
+]
+PAIR_IDS = [scalar.__name__ for scalar, _ in PAIRS]
+
+
+def assert_agree(scalar, vectorized, values):
+    values = pd.Series(values, dtype=object)
+    actual = vectorized(values)
+    for value, got in zip(values, actual):
+        assert got == scalar(value), f"{scalar.__name__}({value!r})"
+
+
+@pytest.mark.parametrize("scalar, vectorized", PAIRS, ids=PAIR_IDS)
+@pytest.mark.parametrize("value", SAMPLE_VALUES)
+def test_sample_value(scalar, vectorized, value):
+    assert_agree(scalar, vectorized, [value])
+
+
+@pytest.mark.parametrize("scalar, vectorized", PAIRS, ids=PAIR_IDS)
+@pytest.mark.parametrize("seed", range(5))
+def test_random_values(scalar, vectorized, seed):
+    rng = random.Random(seed)
+    assert_agree(scalar, vectorized, SAMPLE_VALUES + [random_value(rng) for _ in range(2000)])
+
+
+@pytest.mark.parametrize("scalar, vectorized", PAIRS, ids=PAIR_IDS)
+def test_missing_and_non_string_values(scalar, vectorized):
+    assert_agree(scalar, vectorized, [None, float("nan"), 123456789, 60123456789.0])
+
+
+def test_keeps_index():
+    values = pd.Series(["A@B.COM", "012-345 6789"], index=[10, 20], dtype=object)
+    result = normalize_identifier_series(values)
+    assert list(result.index) == [10, 20]
+    assert list(result) == ["a@b.com", "0123456789"]
+
+
+def test_check_reports_no_mismatches():
+    assert check(SAMPLE_VALUES) == []
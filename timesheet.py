@@ -0,0 +1,97 @@
+"""Hours worked, late arrivals and missing clock-outs from the attendance frame.
+
+shifts() turns attendance rows into one row per shift with its length in
+minutes; totals() sums those per user (or for the whole org) by day, ISO
+week or month. Both are column arithmetic over the whole frame, with no
+per-row Python, so a multi-year history costs a few vectorized passes.
+
+A clock-out earlier than the clock-in means the shift ended after midnight.
+A shift without a clock-out is open: still running if it started today,
+otherwise a missing clock-out, which counts no hours.
+
+Works on the all-string frame as stored and on the compact frame of
+schema.py (datetime dates, seconds-since-midnight times).
+"""
+import numpy as np
+import pandas as pd
+
+DAY = "day"
+WEEK = "week"
+MONTH = "month"
+PERIODS = [DAY, WEEK, MONTH]
+PERIOD_LABELS = {DAY: "Daily", WEEK: "Weekly", MONTH: "Monthly"}
+DEFAULT_LATE_AFTER = "09:00:00"
+
+USER_KEYS = ["User ID", "Name", "Email", "Phone"]
+SECONDS_PER_DAY = 24 * 3600
+
+
+def _dates(values):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return pd.to_datetime(values.astype(str), format="%Y-%m-%d", errors="coerce")
+
+
+def clock_seconds(values):
+    """Seconds since midnight of "HH:MM:SS" strings or integer seconds; empty / unparseable -> NaN."""
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype("float64")
+    strings = values.astype(str)
+    # Fast path: read the digits of exactly "HH:MM:SS" straight from the code
+    # points (as U9, so a 9th character marks a longer string); the rest, if
+    # any, goes through pd.to_timedelta, which is ~10x slower per value
+    chars = strings.to_numpy(dtype="U9").view(np.uint32).reshape(-1, 9).astype(np.int64)
+    digits = chars[:, [0, 1, 3, 4, 6, 7]] - ord("0")
+    fixed = (((digits >= 0) & (digits <= 9)).all(axis=1) & (chars[:, 2] == ord(":")) &
+             (chars[:, 5] == ord(":")) & (chars[:, 8] == 0))
+    seconds = (digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 2] * 10 + digits[:, 3]) * 60 + digits[:, 4] * 10 + digits[:, 5]
+    result = pd.Series(np.where(fixed, seconds, np.nan), index=values.index)
+    rest = ~fixed & (strings != "").to_numpy()
+    if rest.any():
+        result[rest] = pd.to_timedelta(strings[rest], errors="coerce").dt.total_seconds()
+    return result
+
+
+def shift_minutes(time, clock_out_time):
+    """Minutes between clock-in and clock-out (across midnight if earlier); NaN while open."""
+    return ((clock_seconds(clock_out_time) - clock_seconds(time)) % SECONDS_PER_DAY) / 60
+
+
+def shifts(att, today, late_after=DEFAULT_LATE_AFTER):
+    """One row per shift: user keys, Date, Minutes (NaN while open), Late, Open, Missing Clock-Out."""
+    dates = _dates(att["Clock In Date"])
+    start = clock_seconds(att["Time"])
+    is_open = clock_seconds(att["Clock Out Time"]).isna()
+    out = pd.DataFrame({key: att[key].astype(str) for key in USER_KEYS}, index=att.index)
+    out["Date"] = dates
+    out["Minutes"] = shift_minutes(att["Time"], att["Clock Out Time"])
+    out["Late"] = (start > pd.to_timedelta(late_after).total_seconds()).to_numpy()
+    out["Open"] = is_open.to_numpy()
+    out["Missing Clock-Out"] = (is_open & (dates < pd.Timestamp(today))).to_numpy()
+    return out
+
+
+def period_start(dates, period):
+    """First day of the day / ISO week (Monday) / month each date falls in."""
+    dates = dates.dt.normalize()
+    if period == WEEK:
+        return dates - pd.to_timedelta(dates.dt.weekday, unit="D")
+    if period == MONTH:
+        return dates - pd.to_timedelta(dates.dt.day - 1, unit="D")
+    return dates
+
+
+def totals(shift_rows, period, by_user=True):
+    """Shifts, Hours, Late and Missing Clock-Outs per period (and per user), newest period first."""
+    frame = shift_rows.assign(Period=period_start(shift_rows["Date"], period))
+    keys = (USER_KEYS if by_user else []) + ["Period"]
+    grouped = frame.groupby(keys, sort=False, dropna=False).agg(
+        Shifts=("Minutes", "size"),
+        Minutes=("Minutes", "sum"),
+        Late=("Late", "sum"),
+        **{"Missing Clock-Outs": ("Missing Clock-Out", "sum")},
+    ).reset_index()
+    grouped.insert(len(keys) + 1, "Hours", (grouped.pop("Minutes") / 60).round(2))
+    grouped["Period"] = grouped["Period"].dt.strftime("%Y-%m-%d")
+    order = ["Period"] + (["Name", "Email", "Phone"] if by_user else [])
+    return grouped.sort_values(order, ascending=[False] + [True] * (len(order) - 1), ignore_index=True)